@@ -44,14 +44,20 @@
 
 from __future__ import unicode_literals, absolute_import
 
-import os, sys
+import os
+import socket
+import argparse
 import logging.handlers
 
-from legendastv import g, filetools, subtitles, utils
-from legendastv.providers import legendastv
+from legendastv import g, filetools, utils, daemon
+
+# legendastv.subtitles and its dependencies are slow to import, and not
+# needed when jobs are delegated to a daemon, so they are imported on use
 
 
 def run_demo():
+    from legendastv.providers import legendastv
+
     # API tests
     log.info("Running API demo mode")
     search = "gattaca"
@@ -89,22 +95,73 @@ def setup_logging():
     return log
 
 
-def main(args):
-    for path in args:
-        filename = os.path.expanduser(unicode(path, "utf-8"))
+def parseargs(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Search, download and extract subtitles for video files."
+                    " Directories are searched recursively for videos")
+
+    parser.add_argument('--daemon', '-d', action='store_true',
+                        help="run as a daemon, keeping a logged in session and"
+                        " caches for jobs sent by other invocations")
+
+    parser.add_argument('--wait', '-w', action='store_true',
+                        help="if a daemon is running, wait for it to finish the"
+                        " jobs sent, instead of returning once they're queued")
 
-        if os.path.isdir(filename):
-            for root, _, files in os.walk(filename):
-                for video in files:
-                    videofile = os.path.join(root, video)
-                    if filetools.is_video(videofile):
-                        subtitles.retrieve_subtitle_for_movie(videofile)
+    parser.add_argument('--jobs', '-j', type=int, metavar='N',
+                        help="retrieve subtitles for up to N videos at a time,"
+                        " default %d" % g.options['jobs'])
 
-        elif os.path.isfile(filename):
-            subtitles.retrieve_subtitle_for_movie(filename)
+    parser.add_argument('paths', nargs='*', metavar='PATH',
+                        help="video files or directories. Without any, runs"
+                        " an API demo")
 
-        else:
-            log.warn("Ignoring path %s", filename)
+    return parser.parse_args(argv)
+
+
+def delegate(paths, wait=False):
+    """ Send paths to a running daemon, if any. Return whether it was sent """
+    paths = [os.path.abspath(os.path.expanduser(unicode(path, "utf-8")))
+             for path in paths]
+    try:
+        replies = daemon.client(paths, wait)
+    except socket.error:
+        return False
+
+    if not wait:
+        log.info("%d videos queued by daemon", replies)
+        return True
+
+    for reply in replies:
+        if reply['error']:
+            log.error("%s: %s", reply['path'], reply['error'])
+        elif not reply['result']:
+            log.warn("%s: no subtitle found", reply['path'])
+    return True
+
+
+def main(args, jobs=None):
+    """ Retrieve subtitles for video files and directories in args, up to
+        jobs at a time. Errors are reported but not raised, so a single
+        file can't abort a whole directory scan
+    """
+    from legendastv import subtitles, batch
+
+    summary = batch.Batch(jobs).run([unicode(path, "utf-8") for path in args])
+    if summary['failed']:
+        utils.notify("%d of %d videos failed, check log for details",
+                     summary['failed'], summary['videos'])
+
+    if subtitles._provider is not None:
+        log.debug("Connection pool stats: %s", subtitles._provider.pool.stats)
+        log.debug("Response cache stats: %s",
+                  subtitles._provider.response_cache.stats)
+        log.debug("Rate limiter stats: %s",
+                  subtitles._provider.limiter.metrics())
+        log.debug("Compression stats: %s",
+                  subtitles._provider.decompression.stats)
+        log.debug("Asset fetch stats: %s", subtitles._provider.assets.stats)
+        log.debug("Catalog stats: %s", subtitles._provider.catalog.stats)
 
 
 if __name__ == "__main__":
@@ -116,16 +173,20 @@ if __name__ == "__main__":
     if g.options['debug']:
         log.setLevel(logging.DEBUG)
 
+    args = parseargs()
+
     if not (g.options['login'] and g.options['password']):
         log.warn("Login or password are blank. Some features may be disabled.\n\t"
                  "To fill them in, edit your config file: %s",
                  g.globals['config_file'])
 
     try:
-        if len(sys.argv) < 2:
+        if args.daemon:
+            daemon.Daemon(jobs=args.jobs).serve()
+        elif not args.paths:
             run_demo()
-        else:
-            main(sys.argv[1:])
+        elif not delegate(args.paths, args.wait):
+            main(args.paths, args.jobs)
     except KeyboardInterrupt:
         pass
     except g.LegendasError as e:
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2012 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#    This file is part of Legendas.TV Subtitle Downloader
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+#
+# Batch retrieval of subtitles for many videos, by a pool of workers.
+# Each video, or all episodes of a season together, is a job of network bound
+# stages (searches and downloads, by provider) and CPU bound stages (ranking,
+# extraction and cleanup). Stages are limited separately, so workers waiting
+# on the network don't starve the CPU, and no provider gets more jobs in
+# flight than its cap
+
+from __future__ import unicode_literals, absolute_import, division
+
+import os
+import time
+import logging
+import threading
+import functools
+import itertools
+import contextlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from . import g, net
+
+log = logging.getLogger(__name__)
+
+
+class Slots(object):
+    """ Counting semaphore for up to size holders, unlimited if size is 0.
+        Waiting for a slot obeys the deadline of current thread, see net
+    """
+    def __init__(self, size=0):
+        self.size = size
+        self.active = 0
+        self.waited = 0.0  # total time spent waiting for a slot
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        if not self.size:
+            return
+        start = time.time()
+        with self._cond:
+            while self.active >= self.size:
+                self._cond.wait(net.timeout(None))
+            self.active += 1
+            self.waited += time.time() - start
+
+    def release(self):
+        if not self.size:
+            return
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class Limits(object):
+    """ Concurrency limits of a batch: up to network jobs in network bound
+        stages, of which up to provider for each provider, and up to cpu in
+        CPU bound stages. 0 is unlimited
+    """
+    def __init__(self, network=0, cpu=0, provider=0):
+        self.provider = provider
+        self._network = Slots(network)
+        self._cpu = Slots(cpu)
+        self._providers = {}
+        self._lock = threading.Lock()
+
+    def _provider_slots(self, name):
+        with self._lock:
+            if name not in self._providers:
+                self._providers[name] = Slots(self.provider)
+            return self._providers[name]
+
+    @contextlib.contextmanager
+    def network(self, provider):
+        # Provider slot first, so a job waiting for a busy provider doesn't
+        # hold a network slot other providers could use
+        with self._provider_slots(provider):
+            with self._network:
+                yield
+
+    def cpu(self):
+        return self._cpu
+
+    def stats(self):
+        """ Seconds spent waiting for each limit """
+        with self._lock:
+            stats = dict(("provider %s" % name, round(slots.waited, 2))
+                         for name, slots in self._providers.iteritems())
+        stats['network'] = round(self._network.waited, 2)
+        stats['cpu'] = round(self._cpu.waited, 2)
+        return stats
+
+
+# Limits of the batch each thread works for, set by its workers, so
+# batches running at once keep their own. Unlimited outside batches
+_local = threading.local()
+_unlimited = Limits()
+
+
+def _limits():
+    return getattr(_local, 'limits', _unlimited)
+
+
+def network(provider):
+    """ Context manager for a network bound stage of a job, using provider """
+    return _limits().network(provider)
+
+
+def cpu():
+    """ Context manager for a CPU bound stage of a job """
+    return _limits().cpu()
+
+
+def find_videos(paths):
+    """ Video files in paths, searching directories recursively """
+    from . import filetools
+    for path in paths:
+        path = os.path.abspath(os.path.expanduser(path))
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for video in sorted(files):
+                    videofile = os.path.join(root, video)
+                    if filetools.is_video(videofile):
+                        yield videofile
+        elif os.path.isfile(path):
+            yield path
+        else:
+            log.warn("Ignoring path %s", path)
+
+
+class Batch(object):
+    """ Retrieve subtitles for many videos with up to jobs workers, by
+        default from options. Network bound stages are limited to jobs,
+        and to provider_jobs for each provider, CPU bound ones to cpu_jobs,
+        by default the number of CPUs.
+        Each video must be done within the 'deadline' option seconds, its
+        inspection and retrieval together, not counting the time waiting
+        in between for a worker. A group of videos is retrieved within the
+        time left to the one whose inspection took the longest
+    """
+    # Results of a job
+    FOUND, MISSING, FAILED = "found", "missing", "failed"
+
+    def __init__(self, jobs=None, cpu_jobs=None, provider_jobs=None):
+        self.jobs = max(1, jobs or g.options['jobs'])
+        cpu_jobs = cpu_jobs or g.options['cpu_jobs']
+        if not cpu_jobs:
+            try:
+                cpu_jobs = multiprocessing.cpu_count()
+            except NotImplementedError:
+                cpu_jobs = 1
+        if provider_jobs is None:
+            provider_jobs = g.options['provider_jobs']
+        self.limits = Limits(network=self.jobs,
+                             cpu=min(self.jobs, cpu_jobs),
+                             provider=min(self.jobs, provider_jobs))
+        self.results = {}  # path -> FOUND, MISSING or FAILED
+        self.spent = {}    # path -> seconds its inspection took
+        self.errors = []   # (path, message) of FAILED jobs
+        self._lock = threading.Lock()
+
+    def inspect(self, path):
+        """ Movie info of a video, see subtitles.movie_info(), with its path,
+            or the exception that failed it
+        """
+        from . import subtitles
+        start = time.time()
+        try:
+            with net.deadline(g.options['deadline']):
+                movie = subtitles.movie_info(path)
+        except Exception as e:
+            if not isinstance(e, g.LegendasError):
+                log.error("Error inspecting %s: %s", path, e, exc_info=1)
+            return e
+        with self._lock:
+            self.spent[path] = time.time() - start
+        movie['path'] = path
+        return movie
+
+    def retrieve(self, movies):
+        """ Retrieve subtitles for a group of movies, see
+            subtitles.retrieve_subtitles(). Return a list of their results
+            and, if failed, error messages
+        """
+        from . import subtitles
+        deadline = g.options['deadline']
+        if deadline:
+            with self._lock:
+                spent = max(self.spent.get(movie['path'], 0)
+                            for movie in movies)
+            # Negative if already expired, see net.deadline()
+            deadline = deadline - spent or -1
+        try:
+            results = subtitles.retrieve_subtitles(movies, deadline)
+        except Exception as e:
+            if not isinstance(e, g.LegendasError):
+                log.error("Error retrieving subtitles for %s: %s",
+                          movies[0]['filename'], e, exc_info=1)
+            results = [e] * len(movies)
+        return [self._result(result) for result in results]
+
+    def _result(self, result):
+        if isinstance(result, Exception):
+            return self.FAILED, "%s" % result
+        if result:
+            return self.FOUND, None
+        return self.MISSING, None
+
+    def run(self, paths, done=None):
+        """ Retrieve subtitles for all videos in paths, logging progress and
+            calling done(path, result, error), if set, as each one is done.
+            Each video is retrieved as soon as it is inspected, except
+            episodes of the same season, retrieved together once all are
+            inspected, see subtitles.group_episodes().
+            Return the summary() of results
+        """
+        from . import subtitles
+
+        videos = list(find_videos(paths))
+        total = len(videos)
+        log.info("%d videos to search subtitles for, %d at a time",
+                 total, self.jobs)
+
+        start = time.time()
+        progress = functools.partial(self._done, start=start, total=total,
+                                     done=done)
+
+        def finish(group, results):
+            for movie, (result, error) in zip(group, results):
+                progress(movie['path'], result, error)
+
+        # Separate pools, so retrievals don't queue behind inspections
+        inspectors = ThreadPool(self.jobs, self._worker)
+        retrievers = ThreadPool(self.jobs, self._worker)
+        try:
+            movies = self._inspected(
+                itertools.izip(videos, inspectors.imap(self.inspect, videos)),
+                progress)
+            for group in subtitles.group_episodes(movies):
+                retrievers.apply_async(self.retrieve, (group,),
+                                       callback=functools.partial(finish,
+                                                                  group))
+            retrievers.close()
+            retrievers.join()
+        finally:
+            for pool in (inspectors, retrievers):
+                pool.terminate()
+                pool.join()
+
+        summary = self.summary()
+        summary['elapsed'] = round(time.time() - start, 1)
+        log.info("%(videos)d videos in %(elapsed)ss: %(found)d subtitles"
+                 " found, %(missing)d missing, %(failed)d failed", summary)
+        for path, error in self.errors:
+            log.warn("Failed %s: %s", path, error)
+        log.debug("Time waiting for limits: %s", self.limits.stats())
+        return summary
+
+    def _worker(self):
+        """ Set up a worker thread of this batch """
+        _local.limits = self.limits
+
+    def _inspected(self, inspections, progress):
+        """ Movies of (path, movie) inspections, as they are done, reporting
+            the failed ones
+        """
+        for path, movie in inspections:
+            if isinstance(movie, Exception):
+                progress(path, self.FAILED, "%s" % movie)
+            else:
+                yield movie
+
+    def _done(self, path, result, error, start, total, done=None):
+        """ Record the result of a video, log progress, and call done """
+        with self._lock:
+            self.results[path] = result
+            if error:
+                self.errors.append((path, error))
+            count = len(self.results)
+        elapsed = time.time() - start
+        log.info("[%d/%d] %s: %s, %d:%02d left", count, total,
+                 os.path.basename(path), result,
+                 *divmod(elapsed / count * (total - count), 60))
+        if done is not None:
+            try:
+                done(path, result, error)
+            except Exception as e:
+                log.error("Error reporting %s: %s", path, e, exc_info=1)
+
+    def summary(self):
+        """ Number of videos by result, and in total """
+        with self._lock:
+            values = self.results.values()
+        summary = dict((result, values.count(result))
+                       for result in (self.FOUND, self.MISSING, self.FAILED))
+        summary['videos'] = len(values)
+        return summary
@@ -0,0 +1,641 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2012 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#    This file is part of Legendas.TV Subtitle Downloader
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+
+'''Micro-benchmarks for performance sensitive code, using synthetic data.
+    Accuracy is also checked against a fixed list of real release names.
+    No network access is required. Usage: python -m legendastv.benchmark
+'''
+
+from __future__ import unicode_literals, absolute_import, division
+
+import os
+import sys
+import time
+import random
+import argparse
+import logging
+import subprocess
+
+log = logging.getLogger(__name__)
+
+
+def timeit(func, repeat=5):
+    """ Best wall time, in seconds, of repeat calls to func() """
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def listing_page(rows, seed=0):
+    """ HTML of a synthetic subtitle listing page, as in carrega_legendas_busca """
+    rnd = random.Random(seed)
+    divs = []
+    for i in xrange(rows):
+        cls = rnd.choice(['', '', '', 'pack', 'destaque'])
+        release = "%sshow.s%02de%02d.720p.hdtv.x264-grp%d" % (
+            "(p)" if cls == 'pack' else "", rnd.randint(1, 9),
+            rnd.randint(1, 24), i)
+        divs.append(
+            '<div class="%s"><span class="number number_2">%d</span>'
+            '<div class="f_left"><p><a href="/download/%032x/Show/%s">%s</a></p>'
+            '<p class="data">%d downloads, nota %d, enviado por '
+            '<a href="/usuario/user%d">user%d</a> em %02d/%02d/%d - %02d:%02d </p>'
+            '</div><img src="/img/idioma/icon_%s.png" alt="" title=""></div>'
+            % (cls, i, rnd.getrandbits(128), release, release,
+               rnd.randint(0, 5000), rnd.randint(0, 10), i % 50, i % 50,
+               rnd.randint(1, 28), rnd.randint(1, 12), rnd.randint(2005, 2015),
+               rnd.randint(0, 23), rnd.randint(0, 59),
+               rnd.choice(['brazil', 'usa', 'pt', 'es'])))
+    return ('<html><body><article>%s</article>'
+            '<a class="load_more" href="/util/carrega_legendas_busca/show/-/-/2">'
+            '</a></body></html>' % "".join(divs))
+
+
+def bench_listing(size):
+    """ Subtitle listing page parsing, in rows per second """
+    from lxml import html
+    from .providers.legendastv import LegendasTV
+
+    ltv = LegendasTV()
+    page = listing_page(size).encode('utf-8')
+
+    def parse():
+        return html.document_fromstring(page, parser=ltv._parser())
+
+    tree = parse()
+    rows = len(list(ltv._parse_listing(tree)))
+    t_parse = timeit(parse)
+    t_rows  = timeit(lambda: list(ltv._parse_listing(tree)))
+
+    log.info("listing: %d rows", rows)
+    log.info("  HTML parse    : %8.1f ms, %10.0f rows/s",
+             1000 * t_parse, rows / t_parse)
+    log.info("  row extraction: %8.1f ms, %10.0f rows/s",
+             1000 * t_rows, rows / t_rows)
+    log.info("  total         : %8.1f ms, %10.0f rows/s",
+             1000 * (t_parse + t_rows), rows / (t_parse + t_rows))
+
+
+# Real titles, release groups and tags, to build scene-like release names
+TITLES = ["Game of Thrones", "Breaking Bad", "The Big Bang Theory",
+          "The Walking Dead", "House of Cards", "Vikings", "Sherlock",
+          "Mad Men", "Homeland", "The Office US", "How I Met Your Mother",
+          "Gattaca", "The Matrix", "Inception", "Interstellar",
+          "The Lord of the Rings The Two Towers", "Pulp Fiction", "Fargo",
+          "True Detective", "Orange Is the New Black", "Dexter", "Lost",
+          "The Good Wife", "Modern Family", "Arrow", "The Flash"]
+GROUPS = ["LOL", "DIMENSION", "IMMERSE", "KILLERS", "FLEET", "2HD", "ASAP",
+          "EVOLVE", "AFG", "SPARKS", "DEFLATE", "AXXO", "FGT", "YIFY"]
+RESOLUTIONS = ["", "480p", "720p", "1080p"]
+SOURCES = ["HDTV", "WEB-DL", "WEBRip", "BluRay", "BRRip", "DVDRip"]
+CODECS = ["x264", "XviD", "h264", "AAC2.0.H.264", "DD5.1.x264"]
+
+
+def release_name(rnd, title=None, episode=None):
+    """ A random scene-like release name, as a dict of its fields plus
+        'name', the release name itself. episode is a (season, episode)
+        tuple, random by default, or False for a movie
+    """
+    title = title or rnd.choice(TITLES)
+    if episode is None:
+        episode = (rnd.randint(1, 9), rnd.randint(1, 24))
+    year = "" if episode else str(rnd.randint(1970, 2015))
+    fields = dict(title=title, year=year, episode=episode,
+                  resolution=rnd.choice(RESOLUTIONS),
+                  source=rnd.choice(SOURCES), codec=rnd.choice(CODECS),
+                  group=rnd.choice(GROUPS))
+    fields['name'] = format_release(fields)
+    return fields
+
+
+def format_release(fields, sep=".", lower=False):
+    """ Release name of fields, as returned by release_name() """
+    parts = fields['title'].split()
+    if fields['episode']:
+        parts.append("S%02dE%02d" % fields['episode'])
+    parts.extend(fields[_] for _ in ('year', 'resolution', 'source', 'codec')
+                 if fields[_])
+    name = "%s-%s" % (sep.join(parts), fields['group'])
+    return name.lower() if lower else name
+
+
+def release_queries(count, candidates=30, seed=0):
+    """ Yield count 2-tuples (query, releases), query being the video file
+        name of a release, and releases a list of candidate subtitle releases
+        whose first one is the same release as query, with different
+        punctuation and case. The others are decoys: same title and episode
+        from other groups, other episodes of the same title, other titles
+    """
+    rnd = random.Random(seed)
+    for _ in xrange(count):
+        wanted = release_name(rnd)
+        query = format_release(wanted, rnd.choice(".  _"))
+        releases = [format_release(wanted, rnd.choice(". "),
+                                   rnd.random() < 0.5)]
+        for i in xrange(1, candidates):
+            kind = i % 3
+            if kind == 0:
+                decoy = release_name(rnd, wanted['title'], wanted['episode'])
+            elif kind == 1:
+                decoy = release_name(rnd, wanted['title'],
+                                     wanted['episode'] and None)
+            else:
+                decoy = release_name(rnd)
+            if decoy['name'].lower() != releases[0].lower():
+                releases.append(decoy['name'])
+        yield query, releases
+
+
+# Real video file names, each with the subtitle release synced to it and
+# decoys, other releases of the same title as found in its listings
+REAL_MATCHES = [
+    ("Game.of.Thrones.S04E02.720p.HDTV.x264-IMMERSE.mkv",
+     "Game.of.Thrones.S04E02.720p.HDTV.x264-IMMERSE",
+     ["Game.of.Thrones.S04E02.HDTV.x264-KILLERS",
+      "Game.of.Thrones.S04E02.1080p.HDTV.x264-BATV",
+      "Game.of.Thrones.S04E02.HDTV.XviD-AFG",
+      "Game.of.Thrones.S04E03.720p.HDTV.x264-IMMERSE"]),
+    ("breaking.bad.s05e14.720p.hdtv.x264-evolve.mkv",
+     "Breaking.Bad.S05E14.720p.HDTV.x264-EVOLVE",
+     ["Breaking.Bad.S05E14.HDTV.x264-ASAP",
+      "Breaking.Bad.S05E14.Ozymandias.720p.WEB-DL.DD5.1.H.264-BS",
+      "Breaking.Bad.S05E14.HDTV.XviD-AFG",
+      "Breaking.Bad.S05E15.720p.HDTV.x264-EVOLVE"]),
+    ("The.Big.Bang.Theory.S07E01.HDTV.x264-LOL.mp4",
+     "The.Big.Bang.Theory.S07E01.HDTV.x264-LOL",
+     ["The.Big.Bang.Theory.S07E01.720p.HDTV.X264-DIMENSION",
+      "The.Big.Bang.Theory.S07E01.1080p.HDTV.X264-DIMENSION",
+      "The.Big.Bang.Theory.S07E01.HDTV.XviD-AFG",
+      "The.Big.Bang.Theory.S07E02.HDTV.x264-LOL"]),
+    ("The.Walking.Dead.S04E08.720p.HDTV.x264-KILLERS.mkv",
+     "The Walking Dead S04E08 720p HDTV x264-KILLERS",
+     ["The.Walking.Dead.S04E08.HDTV.x264-ASAP",
+      "The.Walking.Dead.S04E08.1080p.WEB-DL.DD5.1.H.264-Abjex",
+      "The.Walking.Dead.S04E08.HDTV.XviD-AFG"]),
+    ("sherlock.3x01.the_empty_hearse.720p_hdtv_x264-fov.mkv",
+     "Sherlock.S03E01.720p.HDTV.x264-FoV",
+     ["Sherlock.S03E01.HDTV.x264-FoV",
+      "Sherlock.S03E01.1080p.HDTV.x264-FoV",
+      "Sherlock.S03E01.The.Empty.Hearse.720p.WEB-DL.AAC2.0.H.264-ECI"]),
+    ("Homeland.S03E12.720p.HDTV.x264-IMMERSE.mkv",
+     "Homeland S03E12 The Star 720p HDTV x264-IMMERSE",
+     ["Homeland.S03E12.HDTV.x264-2HD",
+      "Homeland.S03E12.1080p.HDTV.x264-BATV",
+      "Homeland.S03E12.720p.WEB-DL.DD5.1.H.264-NTb"]),
+    ("how.i.met.your.mother.s09e23e24.720p.hdtv.x264-dimension.mkv",
+     "How.I.Met.Your.Mother.S09E23-E24.720p.HDTV.x264-DIMENSION",
+     ["How.I.Met.Your.Mother.S09E23-E24.HDTV.x264-EXCELLENCE",
+      "How.I.Met.Your.Mother.S09E23.HDTV.x264-EXCELLENCE",
+      "How.I.Met.Your.Mother.S09E23-E24.1080p.WEB-DL.DD5.1.H.264-BS"]),
+    ("True.Detective.S01E08.720p.HDTV.x264-2HD.mkv",
+     "True.Detective.S01E08.720p.HDTV.x264-2HD",
+     ["True.Detective.S01E08.HDTV.x264-2HD",
+      "True.Detective.S01E08.1080p.WEB-DL.DD5.1.H.264-BS",
+      "True.Detective.S01E08.Form.and.Void.720p.WEB-DL.DD5.1.H.264-NTb"]),
+    ("Vikings.S03E01.720p.HDTV.x264-KILLERS.mkv",
+     "Vikings.S03E01.720p.HDTV.x264-KILLERS",
+     ["Vikings.S03E01.HDTV.x264-KILLERS",
+      "Vikings.S03E01.1080p.HDTV.x264-KILLERS",
+      "Vikings.S03E01.720p.WEB-DL.DD5.1.H.264-KiNGS"]),
+    ("Gattaca.1997.1080p.BluRay.x264-CiNEFiLE.mkv",
+     "Gattaca.1997.1080p.BluRay.x264-CiNEFiLE",
+     ["Gattaca.1997.720p.BluRay.x264-CiNEFiLE",
+      "Gattaca.1997.DVDRip.XviD-FRAGMENT",
+      "Gattaca (1997) [1080p] BrRip x264 - YIFY"]),
+    ("Inception.2010.720p.BluRay.x264-REFiNED.mkv",
+     "Inception.2010.720p.BluRay.x264-REFiNED",
+     ["Inception.2010.1080p.BluRay.x264-REFiNED",
+      "Inception.2010.DVDRip.XviD-MAXSPEED",
+      "Inception 2010 BRRip 720p x264 AAC-FLAWL3SS"]),
+    ("Interstellar.2014.720p.BluRay.x264-SPARKS.mkv",
+     "Interstellar.2014.720p.BluRay.x264-SPARKS",
+     ["Interstellar.2014.1080p.BluRay.x264-SPARKS",
+      "Interstellar.2014.720p.BRRip.x264.AAC-ETRG",
+      "Interstellar.2014.DVDSCR.XviD-EVO"]),
+    ("Pulp.Fiction.1994.720p.BrRip.x264.YIFY.mp4",
+     "Pulp Fiction 1994 720p BrRip x264 YIFY",
+     ["Pulp.Fiction.1994.1080p.BrRip.x264.YIFY",
+      "Pulp.Fiction.1994.720p.BluRay.x264-SiNNERS",
+      "Pulp.Fiction.DVDRip.XviD-DoNE"]),
+    ("The.Matrix.1999.1080p.BluRay.x264-CtrlHD.mkv",
+     "The Matrix 1999 1080p BluRay x264-CtrlHD",
+     ["The.Matrix.1999.720p.BluRay.x264-CtrlHD",
+      "The.Matrix.1999.1080p.BluRay.x264-SiNNERS",
+      "The.Matrix.1999.DVDRip.XviD-DiAMOND"]),
+]
+
+
+def real_matches():
+    """ REAL_MATCHES as 2-tuples (query, releases) like release_queries(),
+        query without its file extension, and the release synced to it
+        first in releases
+    """
+    return [(os.path.splitext(video)[0], [release] + decoys)
+            for video, release, decoys in REAL_MATCHES]
+
+
+def bench_similarity(size):
+    """ Speed and ranking accuracy of each string similarity engine, scoring
+        every pair, and choosing the best with datatools.choose_best_string()
+    """
+    from . import g, datatools as dt
+
+    queries = [(dt.clean_string(query).lower(),
+                [dt.clean_string(r).lower() for r in releases])
+               for query, releases in release_queries(max(1, size // 30))]
+    pairs = sum(len(releases) for _, releases in queries)
+    reference = dt.engines['difflib']
+    reference_best = [max(xrange(len(releases)),
+                          key=lambda i: reference(query, releases[i]))
+                      for query, releases in queries]
+
+    # Ties are not top-1 correct, as the release synced to the video
+    # comes first
+    real = [(dt.clean_string(query).lower(),
+             [dt.clean_string(r).lower() for r in releases])
+            for query, releases in real_matches()]
+
+    engine_option = g.options['similarity_engine']
+    log.info("similarity: %d queries, %d pairs, %d real queries", len(queries),
+             pairs, len(real))
+    for name, engine in sorted(dt.engines.iteritems()):
+        def run():
+            return [max(xrange(len(releases)),
+                        key=lambda i: engine(query, releases[i]))
+                    for query, releases in queries]
+        elapsed = timeit(run, 3)
+        best = run()
+        log.info("  %-12s: %8.1f ms, %10.0f pairs/s, top-1 correct: %5.1f%%,"
+                 " same as difflib: %5.1f%%", name, 1000 * elapsed,
+                 pairs / elapsed,
+                 100 * best.count(0) / len(best),
+                 100 * sum(1 for a, b in zip(best, reference_best)
+                           if a == b) / len(best))
+        correct = sum(1 for query, releases in real
+                      if all(engine(query, releases[0]) > engine(query, r)
+                             for r in releases[1:]))
+        log.info("  %-12s: real releases top-1 correct: %5.1f%%", "",
+                 100 * correct / len(real))
+
+        def choose():
+            return [dt.choose_best_string(query, releases, False)['index']
+                    for query, releases in queries]
+        g.options['similarity_engine'] = name
+        try:
+            pruned = timeit(choose, 3)
+            assert choose() == best
+        finally:
+            g.options['similarity_engine'] = engine_option
+        log.info("  %-12s: %8.1f ms, choose_best_string()", "", 1000 * pruned)
+
+
+# Real release names, with the fields parse_release() should find in them.
+# Fields not given are empty
+REAL_RELEASES = [
+    ("Game.of.Thrones.S04E02.720p.HDTV.x264-IMMERSE",
+     dict(title="Game of Thrones", season=4, episodes=(2,),
+          resolution="720p", source="hdtv", codec="x264", group="IMMERSE")),
+    ("Breaking.Bad.S05E14.Ozymandias.720p.WEB-DL.DD5.1.H.264-BS",
+     dict(title="Breaking Bad", season=5, episodes=(14,),
+          episode_title="Ozymandias", resolution="720p", source="web-dl",
+          codec="h264", audio="dd5.1", group="BS")),
+    ("the.big.bang.theory.s07e01.hdtv.x264-lol",
+     dict(title="the big bang theory", season=7, episodes=(1,),
+          source="hdtv", codec="x264", group="lol")),
+    ("How.I.Met.Your.Mother.S09E23-E24.720p.HDTV.x264-DIMENSION",
+     dict(title="How I Met Your Mother", season=9, episodes=(23, 24),
+          resolution="720p", source="hdtv", codec="x264",
+          group="DIMENSION")),
+    ("sherlock.3x01.the_empty_hearse.720p_hdtv_x264-fov",
+     dict(title="sherlock", season=3, episodes=(1,),
+          episode_title="the empty hearse", resolution="720p",
+          source="hdtv", codec="x264", group="fov")),
+    ("The.Walking.Dead.S04E08.REPACK.HDTV.XviD-AFG",
+     dict(title="The Walking Dead", season=4, episodes=(8,), source="hdtv",
+          codec="xvid", group="AFG", tags=("repack",))),
+    ("House.of.Cards.2013.S02E01.WEBRip.HDTV.x264-2HD",
+     dict(title="House of Cards", year="2013", season=2, episodes=(1,),
+          source="webrip", codec="x264", group="2HD")),
+    ("Doctor.Who.2005.S08E01.Deep.Breath.1080p.HDTV.x264-FoV",
+     dict(title="Doctor Who", year="2005", season=8, episodes=(1,),
+          episode_title="Deep Breath", resolution="1080p", source="hdtv",
+          codec="x264", group="FoV")),
+    ("Vikings.S03.720p.WEB-DL.DD5.1.H.264-BS",
+     dict(title="Vikings", season=3, resolution="720p", source="web-dl",
+          codec="h264", audio="dd5.1", group="BS")),
+    ("Modern.Family.S05E01.PROPER.720p.HDTV.x264-2HD",
+     dict(title="Modern Family", season=5, episodes=(1,),
+          resolution="720p", source="hdtv", codec="x264", group="2HD",
+          tags=("proper",))),
+    ("Gattaca.1997.1080p.BluRay.x264-CiNEFiLE",
+     dict(title="Gattaca", year="1997", resolution="1080p",
+          source="bluray", codec="x264", group="CiNEFiLE")),
+    ("Inception.2010.720p.BluRay.x264-REFiNED",
+     dict(title="Inception", year="2010", resolution="720p",
+          source="bluray", codec="x264", group="REFiNED")),
+    ("Interstellar.2014.720p.BRRip.x264.AAC-ETRG",
+     dict(title="Interstellar", year="2014", resolution="720p",
+          source="brrip", codec="x264", audio="aac", group="ETRG")),
+    ("Pulp.Fiction.1994.720p.BrRip.x264.YIFY",
+     dict(title="Pulp Fiction", year="1994", resolution="720p",
+          source="brrip", codec="x264", group="YIFY")),
+    ("The.Matrix.1999.1080p.BluRay.x264-CtrlHD",
+     dict(title="The Matrix", year="1999", resolution="1080p",
+          source="bluray", codec="x264", group="CtrlHD")),
+    ("Blade.Runner.2049.2017.1080p.WEB-DL.H264.AC3-EVO",
+     dict(title="Blade Runner 2049", year="2017", resolution="1080p",
+          source="web-dl", codec="h264", audio="ac3", group="EVO")),
+    ("2012.2009.720p.BluRay.x264-METiS",
+     dict(title="2012", year="2009", resolution="720p", source="bluray",
+          codec="x264", group="METiS")),
+    ("The.Lord.of.the.Rings.The.Two.Towers.2002.EXTENDED.1080p.BluRay."
+     "x264-SiNNERS",
+     dict(title="The Lord of the Rings The Two Towers", year="2002",
+          resolution="1080p", source="bluray", codec="x264",
+          group="SiNNERS", tags=("extended",))),
+    ("Mad Max Fury Road (2015) [1080p] BluRay x265 HEVC 10bit",
+     dict(title="Mad Max Fury Road", year="2015", resolution="1080p",
+          source="bluray", codec="x265", tags=("10bit",))),
+    ("[rarbg] Fargo.S01E01.720p.HDTV.x264-KILLERS",
+     dict(title="Fargo", season=1, episodes=(1,), resolution="720p",
+          source="hdtv", codec="x264", group="KILLERS")),
+    ("Orange.Is.the.New.Black.S02E01.Thirsty.Bird.1080p.NF.WEBRip.DD5.1."
+     "x264-NTb",
+     dict(title="Orange Is the New Black", season=2, episodes=(1,),
+          episode_title="Thirsty Bird", resolution="1080p", source="webrip",
+          codec="x264", audio="dd5.1", group="NTb", tags=("nf",))),
+    ("The.Office.US.S09E23.Finale.HDTV.x264-LOL",
+     dict(title="The Office US", season=9, episodes=(23,),
+          episode_title="Finale", source="hdtv", codec="x264", group="LOL")),
+    ("Dexter - 8x12 - Remember the Monsters.HDTV.x264-ASAP",
+     dict(title="Dexter", season=8, episodes=(12,),
+          episode_title="Remember the Monsters", source="hdtv",
+          codec="x264", group="ASAP")),
+    ("Lost.Season.6.DVDRip.XviD-REWARD",
+     dict(title="Lost", season=6, source="dvdrip", codec="xvid",
+          group="REWARD")),
+    # Titles with words that are also field tokens
+    ("Cam.2018.1080p.NF.WEBRip.x264-GRP",
+     dict(title="Cam", year="2018", resolution="1080p", source="webrip",
+          codec="x264", group="GRP", tags=("nf",))),
+    ("Charlotte's.Web.2006.720p.BluRay.x264-SiNNERS",
+     dict(title="Charlotte's Web", year="2006", resolution="720p",
+          source="bluray", codec="x264", group="SiNNERS")),
+    ("Dark.Web.S01E01.1080p.WEB.h264-GRP",
+     dict(title="Dark Web", season=1, episodes=(1,), resolution="1080p",
+          source="web", codec="h264", group="GRP")),
+    ("Dead.Man.Down.2013.R5.XviD-GRP",
+     dict(title="Dead Man Down", year="2013", source="r5", codec="xvid",
+          group="GRP")),
+]
+
+RELEASE_FIELDS = ('title', 'year', 'season', 'episodes', 'episode_title',
+                  'resolution', 'source', 'codec', 'audio', 'group', 'tags')
+
+EPISODE_TITLES = ["Pilot", "The Wolf and the Lion", "Four Walls and a Roof",
+                  "High Sparrow", "Ozymandias", "The Rains of Castamere",
+                  "Felina", "A Scandal in Belgravia", "The Reichenbach Fall"]
+
+def bench_release(size):
+    """ Release name parsing speed and accuracy, and ranking accuracy of
+        matching releases by fields against whole string similarity
+    """
+    from . import datatools as dt, normalize as nz, release as rl
+
+    rnd = random.Random(0)
+    corpus = []
+    for _ in xrange(size):
+        fields = release_name(rnd, episode=rnd.choice([None, False]))
+        name = format_release(fields, rnd.choice(". _"), rnd.random() < 0.2)
+        if rnd.random() < 0.1:
+            name = "[%s] %s" % (rnd.choice(["rarbg", "eztv"]), name)
+        corpus.append((name, fields))
+
+    def parse():
+        rl.parse_release.cache_clear()
+        return [rl.parse_release(name) for name, _ in corpus]
+    elapsed = timeit(parse, 3)
+
+    log.info("release: %d names", len(corpus))
+    log.info("  %-13s: %8.1f ms, %10.0f names/s", "parse",
+             1000 * elapsed, len(corpus) / elapsed)
+
+    # Accuracy on real names, as synthetic ones are built from the same
+    # tokens the parser knows
+    empty = dict(season=None, episodes=(), tags=())
+    releases = [rl.parse_release(real[0]) for real in REAL_RELEASES]
+    for field in RELEASE_FIELDS:
+        wrong = [real[0] for real, release in zip(REAL_RELEASES, releases)
+                 if release[field] != real[1].get(field, empty.get(field, ""))]
+        log.info("  %-13s: %5.1f%% correct of %d real names%s", field,
+                 100 * (1 - len(wrong) / len(releases)), len(releases),
+                 ", wrong: %s" % ", ".join(wrong) if wrong else "")
+
+    # Subtitle releases of the same video often add the episode title, or
+    # drop the group dash. Decoys are other encodes of the same episode
+    queries = []
+    for _ in xrange(max(1, size // 30)):
+        wanted = release_name(rnd, episode=(rnd.randint(1, 9),
+                                            rnd.randint(1, 24)))
+        video = format_release(wanted, rnd.choice(". _"))
+        truth = format_release(wanted, rnd.choice(". "))
+        if rnd.random() < 0.5:
+            truth = truth.replace("S%02dE%02d" % wanted['episode'],
+                                  "S%02dE%02d %s" % (wanted['episode'] +
+                                                     (rnd.choice(EPISODE_TITLES),)))
+        if rnd.random() < 0.5:
+            truth = truth.replace("-", " ")
+        candidates = [truth] + [
+            release_name(rnd, wanted['title'], wanted['episode'])['name']
+            for _ in xrange(29)]
+        queries.append((nz.clean_string(video), candidates))
+
+    similarity = dt.similarity_engine()
+    methods = dict(
+        strings = lambda video, candidates: [
+            similarity(nz.normalize(video), nz.normalize(c))
+            for c in candidates],
+        fields  = lambda video, candidates: [
+            rl.match_release(rl.parse_release(video), rl.parse_release(c))
+            for c in candidates],
+    )
+    real = [(nz.clean_string(match[0]), match[1])
+            for match in real_matches()]
+    for name, method in sorted(methods.iteritems()):
+        def accuracy(queries):
+            correct = 0
+            for video, candidates in queries:
+                scores = method(video, candidates)
+                correct += all(scores[0] > score for score in scores[1:])
+            return 100 * correct / len(queries)
+        log.info("  matching by %-7s: %5.1f%% top-1 correct, %5.1f%% of real"
+                 " releases", name, accuracy(queries), accuracy(real))
+
+    # Exact signature fast path, before matching. Memoization cleared, as
+    # each listing is new
+    def match():
+        rl.parse_release.cache_clear()
+        return [methods['fields'](video, candidates)
+                for video, candidates in queries]
+
+    def lookup():
+        rl.signature.cache_clear()
+        return [rl.signature_index(candidates).get(rl.signature(video))
+                for video, candidates in queries]
+
+    hits = lookup()
+    found = sum(1 for hit in hits if hit)
+    correct = sum(1 for hit, (_, candidates) in zip(hits, queries)
+                  if hit and hit[0] == candidates[0])
+    log.info("  signature hits: %5.1f%%, %5.1f%% correct, %6.1f ms,"
+             " matching all by fields: %6.1f ms",
+             100 * found / len(queries), 100 * correct / max(1, found),
+             1000 * timeit(lookup, 3), 1000 * timeit(match, 3))
+
+
+def subtitle_listing(count, seed=0):
+    """ A 2-tuple (movie, subtitles) with the movie dict as built by
+        subtitles.retrieve_subtitle_for_movie(), and a list of count
+        Subtitle records of its title, with random releases and metadata
+    """
+    from datetime import datetime, timedelta
+    from .entities import Subtitle
+
+    rnd = random.Random(seed)
+    wanted = release_name(rnd)
+    movie = dict(title=wanted['title'], release=format_release(wanted, " "),
+                 year=wanted['year'])
+
+    today = datetime.today()
+    subtitles = []
+    for i in xrange(count):
+        fields = release_name(rnd, wanted['title'], wanted['episode'] and None)
+        subtitles.append(Subtitle(
+            hash="%032x" % rnd.getrandbits(128),
+            title=wanted['title'],
+            downloads=rnd.randint(0, 5000),
+            rating=rnd.choice([None, rnd.randint(0, 10)]),
+            date=today - timedelta(minutes=rnd.randint(0, 5 * 365 * 24 * 60)),
+            user_name="user%d" % (i % 50),
+            release=fields['name'],
+            pack=rnd.random() < 0.1,
+            highlight=rnd.random() < 0.2,
+            flag="", language="pb"))
+    return movie, subtitles
+
+
+def bench_ranking(size):
+    """ Subtitle ranking, in subtitles per second, scoring in batch with
+        plain Python and, if installed, NumPy, and in a single pass heap
+    """
+    from . import g, scoring
+    from .providers.legendastv import LegendasTV
+
+    ltv = LegendasTV()
+    movie, subtitles = subtitle_listing(size)
+
+    log.info("ranking: %d subtitles", len(subtitles))
+    vectorize = g.options['vectorize']
+    try:
+        for name in ("python", "numpy"):
+            g.options['vectorize'] = name == "numpy"
+            if g.options['vectorize'] and scoring.numpy() is None:
+                log.info("  %-14s: not installed", name)
+                continue
+            elapsed = timeit(lambda: ltv.rankSubtitles(movie, subtitles))
+            log.info("  %-14s: %8.1f ms, %10.0f subtitles/s",
+                     name, 1000 * elapsed, len(subtitles) / elapsed)
+    finally:
+        g.options['vectorize'] = vectorize
+
+    elapsed = timeit(lambda: ltv.rankSubtitles(movie, iter(subtitles), 10))
+    log.info("  %-14s: %8.1f ms, %10.0f subtitles/s",
+             "top 10 heap", 1000 * elapsed, len(subtitles) / elapsed)
+
+
+# Modules slow to import, or only needed by some features
+HEAVY_MODULES = ('lxml', 'dbus', 'magic', 'pysrt', 'gi', 'rarfile',
+                 'xmlrpclib', 'urllib2', 'legendastv.providers.legendastv',
+                 'legendastv.providers.opensubtitles')
+
+
+def bench_startup(size):
+    """ Import time of each entry point, in fresh interpreters """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    entries = (
+        ('legendastv.py', "import runpy; runpy.run_path(%r)" %
+                          os.path.join(root, 'legendastv.py')),
+        ('srtclean',      "import legendastv.srtclean"),
+        ('subtitles',     "import legendastv.subtitles"),
+        ('daemon client', "import legendastv.daemon"),
+    )
+    code = ("import sys, time; start = time.time(); %s; "
+            "print time.time() - start; "
+            "print ' '.join(m for m in %r if m in sys.modules)")
+
+    for name, statement in entries:
+        best = None
+        for _ in xrange(5):
+            output = subprocess.check_output(
+                [sys.executable, '-c', code % (statement, HEAVY_MODULES)],
+                cwd=root).decode('utf-8').split('\n')
+            elapsed = float(output[0])
+            best = elapsed if best is None else min(best, elapsed)
+        log.info("%-14s: %6.1f ms, loads: %s", name, 1000 * best,
+                 output[1] or "-")
+
+
+benchmarks = dict(
+    listing    = bench_listing,
+    ranking    = bench_ranking,
+    release    = bench_release,
+    similarity = bench_similarity,
+    startup    = bench_startup,
+)
+
+
+def parseargs(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+
+    parser.add_argument('--size', '-s', type=int, default=10000,
+                        help='number of items in synthetic data. [Default: %(default)s]')
+
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help='benchmarks to run, from: %s. [Default: all]' %
+                        ", ".join(sorted(benchmarks)))
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseargs(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    for name in args.names or sorted(benchmarks):
+        if name not in benchmarks:
+            log.error("Unknown benchmark: '%s'", name)
+            continue
+        benchmarks[name](args.size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2012 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#    This file is part of Legendas.TV Subtitle Downloader
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+#
+# Local catalog of title searches and subtitle listings, in a SQLite
+# database, so repeated searches, in a batch or across days, are answered
+# without the website. Unlike the response cache, it keeps parsed records,
+# and knows whether a listing is complete or was cut short by a search
+
+from __future__ import unicode_literals, absolute_import, division
+
+import os
+import time
+import calendar
+import logging
+import sqlite3
+import threading
+import functools
+from datetime import datetime
+
+from . import filetools as ft, normalize as nz
+from .entities import Movie, Subtitle
+
+log = logging.getLogger(__name__)
+
+# Bumped on schema changes, dropping the tables of older versions
+VERSION = 3
+
+_MOVIE_FIELDS = ('id', 'title', 'title_br', 'thumb', 'year', 'type', 'season',
+                 'imdb_id')
+
+_SUBTITLE_FIELDS = ('hash', 'title', 'downloads', 'rating', 'date',
+                    'user_name', 'release', 'pack', 'highlight', 'flag',
+                    'language')
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS movies (
+        id          TEXT PRIMARY KEY,
+        title       TEXT,
+        title_br    TEXT,
+        thumb       TEXT,
+        year        TEXT,
+        type        TEXT,
+        season      TEXT,
+        imdb_id     TEXT
+    );
+    CREATE TABLE IF NOT EXISTS searches (
+        query       TEXT PRIMARY KEY,
+        updated     REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS search_movies (
+        query       TEXT NOT NULL,
+        position    INTEGER NOT NULL,
+        movie_id    TEXT NOT NULL,
+        PRIMARY KEY (query, position)
+    );
+    CREATE TABLE IF NOT EXISTS listings (
+        movie_id    TEXT NOT NULL,
+        lang        TEXT NOT NULL,
+        stype       TEXT NOT NULL,
+        updated     REAL NOT NULL,
+        newest      REAL,
+        pages       INTEGER NOT NULL,
+        complete    INTEGER NOT NULL,
+        PRIMARY KEY (movie_id, lang, stype)
+    );
+    CREATE TABLE IF NOT EXISTS subtitles (
+        movie_id    TEXT NOT NULL,
+        lang        TEXT NOT NULL,
+        stype       TEXT NOT NULL,
+        position    INTEGER NOT NULL,
+        page        INTEGER NOT NULL,
+        hash        TEXT,
+        title       TEXT,
+        downloads   INTEGER,
+        rating      INTEGER,
+        date        INTEGER,
+        user_name   TEXT,
+        release     TEXT,
+        pack        INTEGER,
+        highlight   INTEGER,
+        flag        TEXT,
+        language    TEXT,
+        PRIMARY KEY (movie_id, lang, stype, position)
+    );
+"""
+
+
+def _timestamp(date):
+    """ Seconds since epoch of a naive datetime, taken as UTC so it converts
+        back exactly with _datetime()
+    """
+    return calendar.timegm(date.timetuple()) if date else None
+
+
+def _datetime(timestamp):
+    return datetime.utcfromtimestamp(timestamp) if timestamp is not None else None
+
+
+def _safe(default):
+    """ Decorator for Catalog methods, logging database errors and returning
+        default instead, so a broken catalog can't fail a search
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return method(self, *args, **kwargs)
+            except sqlite3.Error as e:
+                log.warn("Catalog error in %s: %s", self.path, e)
+                return default
+        return wrapper
+    return decorator
+
+
+class Catalog(object):
+    """ SQLite catalog of title searches, by normalized query, and subtitle
+        listings, by movie id, language and type, each with its update time.
+        Title searches are fresh for titles_ttl seconds. Listings are fresh
+        for listings_ttl seconds, or longer for titles with no new subtitles
+        for a while: a quiet fraction of the time since their newest one, up
+        to max_ttl, as a title with no new subtitles for a year is unlikely
+        to get one tomorrow.
+        Stale entries are still returned, so they can be used when the
+        website is down. Entries not updated in max_age seconds are purged.
+        The database is opened on first use, and shared by all threads
+    """
+    quiet = 0.1
+    max_ttl = 30*24*60*60
+    max_age = 90*24*60*60
+
+    def __init__(self, path, titles_ttl=0, listings_ttl=0):
+        self.path = path
+        self.titles_ttl = titles_ttl
+        self.listings_ttl = listings_ttl
+        self.stats = dict(hits=0, stale=0, misses=0, stored=0)
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """ Database connection, opened and set up on first use. Call with
+            self._lock held
+        """
+        if self._db is not None:
+            return self._db
+
+        ft.safemakedirs(os.path.dirname(self.path))
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        try:
+            with db:
+                version = db.execute("PRAGMA user_version").fetchone()[0]
+                if version != VERSION:
+                    log.debug("Creating catalog version %d at %s", VERSION,
+                              self.path)
+                    for table in ('movies', 'searches', 'search_movies',
+                                  'listings', 'subtitles'):
+                        db.execute("DROP TABLE IF EXISTS %s" % table)
+                db.executescript(_SCHEMA)
+                db.execute("PRAGMA user_version = %d" % VERSION)
+            self._purge(db, time.time() - self.max_age)
+        except sqlite3.Error:
+            db.close()
+            raise
+        self._db = db
+        return db
+
+    def _purge(self, db, before):
+        with db:
+            db.execute("DELETE FROM search_movies WHERE query IN"
+                       " (SELECT query FROM searches WHERE updated < ?)",
+                       (before,))
+            db.execute("DELETE FROM searches WHERE updated < ?", (before,))
+            db.execute("DELETE FROM subtitles WHERE EXISTS (SELECT 1"
+                       " FROM listings l WHERE l.movie_id = subtitles.movie_id"
+                       " AND l.lang = subtitles.lang AND l.stype ="
+                       " subtitles.stype AND l.updated < ?)", (before,))
+            db.execute("DELETE FROM listings WHERE updated < ?", (before,))
+            db.execute("DELETE FROM movies WHERE id NOT IN"
+                       " (SELECT movie_id FROM search_movies)"
+                       " AND id NOT IN (SELECT movie_id FROM listings)")
+
+    def _count(self, found, fresh):
+        self.stats['hits' if fresh else 'stale' if found else 'misses'] += 1
+
+    @_safe((None, False))
+    def lookup_movies(self, query):
+        """ Return a 2-tuple (movies, fresh) for a title search query, as
+            passed to getMovies(). movies is a list of Movie records, or None
+            if query is not in catalog
+        """
+        query = nz.normalize(query)
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT updated FROM searches WHERE query = ?",
+                             (query,)).fetchone()
+            if row is None:
+                self._count(False, False)
+                return None, False
+            rows = db.execute(
+                "SELECT %s FROM search_movies s JOIN movies m"
+                " ON m.id = s.movie_id WHERE s.query = ? ORDER BY s.position"
+                % ", ".join("m.%s" % field for field in _MOVIE_FIELDS),
+                (query,)).fetchall()
+            fresh = row[0] > time.time() - self.titles_ttl
+            self._count(True, fresh)
+
+        movies = [Movie(zip(_MOVIE_FIELDS, values)) for values in rows]
+        return movies, fresh
+
+    @_safe(None)
+    def store_movies(self, query, movies):
+        """ Save the results of a title search query, a list of Movie """
+        query = nz.normalize(query)
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO movies VALUES (%s)" %
+                    ", ".join("?" * len(_MOVIE_FIELDS)),
+                    [["%s" % movie['id']] + [movie.get(field)
+                                             for field in _MOVIE_FIELDS[1:]]
+                     for movie in movies])
+                db.execute("DELETE FROM search_movies WHERE query = ?",
+                           (query,))
+                db.executemany("INSERT INTO search_movies VALUES (?, ?, ?)",
+                               [(query, position, "%s" % movie['id'])
+                                for position, movie in enumerate(movies)])
+                db.execute("INSERT OR REPLACE INTO searches VALUES (?, ?)",
+                           (query, time.time()))
+            self.stats['stored'] += 1
+
+    @_safe((None, False, False))
+    def lookup_subtitles(self, movie_id, lang="", stype=""):
+        """ Return a 3-tuple (pages, fresh, complete) for the subtitle
+            listing of a movie id in a language and of a type, as passed to
+            getSubtitles(). pages is a list of its result pages, each a list
+            of Subtitle records, or None if the listing is not in catalog.
+            complete is whether it has all pages, or was cut short
+        """
+        key = ("%s" % movie_id, lang or "", stype or "")
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT updated, newest, pages, complete FROM"
+                             " listings"
+                             " WHERE movie_id = ? AND lang = ? AND stype = ?",
+                             key).fetchone()
+            if row is None:
+                self._count(False, False)
+                return None, False, False
+            rows = db.execute(
+                "SELECT page, %s FROM subtitles WHERE movie_id = ? AND"
+                " lang = ? AND stype = ? ORDER BY position"
+                % ", ".join(_SUBTITLE_FIELDS), key).fetchall()
+            updated, newest, count, complete = row
+            ttl = self.listings_ttl
+            if newest is not None:
+                ttl = max(ttl, min(self.max_ttl,
+                                   self.quiet * (updated - newest)))
+            fresh = updated > time.time() - ttl
+            self._count(True, fresh)
+
+        # Pages without subtitles, as the only one of a title with none yet,
+        # have no rows
+        pages = [[] for _ in xrange(count)]
+        for values in rows:
+            sub = Subtitle(zip(_SUBTITLE_FIELDS, values[1:]))
+            sub.date = _datetime(sub.date)
+            sub.pack = bool(sub.pack)
+            sub.highlight = bool(sub.highlight)
+            pages[values[0] - 1].append(sub)
+        return pages, fresh, bool(complete)
+
+    @_safe(None)
+    def store_subtitles(self, movie_id, lang, stype, pages, complete):
+        """ Save the subtitle listing of a movie id in a language and of a
+            type, a list of its result pages, each a list of Subtitle, and
+            whether it is complete
+        """
+        key = ("%s" % movie_id, lang or "", stype or "")
+        subtitles = [(number, sub) for number, page in enumerate(pages, 1)
+                     for sub in page]
+        dates = [sub['date'] for _, sub in subtitles if sub.get('date')]
+        newest = _timestamp(max(dates)) if dates else None
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute("DELETE FROM subtitles WHERE movie_id = ? AND"
+                           " lang = ? AND stype = ?", key)
+                db.executemany(
+                    "INSERT INTO subtitles VALUES (%s)" %
+                    ", ".join("?" * (len(key) + 2 + len(_SUBTITLE_FIELDS))),
+                    [key + (position, number) +
+                     tuple(_timestamp(sub.get(field)) if field == 'date' else
+                           sub.get(field) for field in _SUBTITLE_FIELDS)
+                     for position, (number, sub) in enumerate(subtitles)])
+                db.execute("INSERT OR REPLACE INTO listings VALUES"
+                           " (?, ?, ?, ?, ?, ?, ?)",
+                           key + (time.time(), newest, len(pages),
+                                  bool(complete)))
+            self.stats['stored'] += 1
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2012 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#    This file is part of Legendas.TV Subtitle Downloader
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+#
+# Long-running daemon holding a logged in session and warm caches, and its
+# client. Jobs are sent over a UNIX socket as JSON lines:
+#   request:  {"paths": [...], "wait": false}
+#   replies:  {"queued": N} if not wait, otherwise one
+#             {"path": ..., "result": ..., "error": ...} for each video,
+#             as soon as it is done
+# The client side only needs the standard library, so it starts fast
+
+from __future__ import unicode_literals, absolute_import
+
+import os
+import json
+import socket
+import logging
+import threading
+import Queue
+import SocketServer
+
+from . import g
+
+log = logging.getLogger(__name__)
+
+
+def socket_path():
+    return os.path.join(g.globals['cache_dir'], "daemon.sock")
+
+
+class _Job(object):
+    __slots__ = ('path', 'result', 'error', 'done')
+
+    def __init__(self, path):
+        self.path = path
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def reply(self):
+        return dict(path=self.path, result=self.result, error=self.error)
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return  # just probing, see daemon_running()
+        try:
+            request = json.loads(line)
+            paths = request['paths']
+        except (ValueError, TypeError, KeyError) as e:
+            self._send(dict(error="Invalid request: %s" % e))
+            return
+
+        jobs = self.server.submit(self.server.find_videos(paths))
+
+        if not request.get('wait'):
+            self._send(dict(queued=len(jobs)))
+            return
+
+        for job in jobs:
+            job.done.wait()
+            self._send(job.reply())
+
+    def _send(self, reply):
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b"\n")
+        self.wfile.flush()
+
+
+class Daemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """ Accept jobs from client() over a UNIX socket, only accessible by
+        its owner, and retrieve their subtitles in a worker thread, one
+        request at a time, each as a batch.Batch of up to jobs workers.
+        The same provider sessions and caches are reused for all
+    """
+    daemon_threads = True
+
+    def __init__(self, path=None, jobs=None):
+        path = path or socket_path()
+        if daemon_running(path):
+            raise g.LegendasError("Daemon already running at %s" % path)
+        if os.path.exists(path):
+            os.remove(path)  # stale, left by a daemon that died
+
+        from . import filetools
+        filetools.safemakedirs(os.path.dirname(path))
+        umask = os.umask(0o077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, _Handler)
+        finally:
+            os.umask(umask)
+
+        self.path = path
+        self.jobs = jobs
+        self._jobs = Queue.Queue()
+        self._worker = threading.Thread(target=self._work,
+                                        name="legendastv-worker")
+        self._worker.daemon = True
+
+    def find_videos(self, paths):
+        """ Video files in paths, searching directories recursively """
+        from . import batch
+        return batch.find_videos(paths)
+
+    def submit(self, paths):
+        """ Queue a request for video paths. Return a list of their jobs """
+        jobs = [_Job(path) for path in paths]
+        self._jobs.put(jobs)
+        return jobs
+
+    def _work(self):
+        from . import batch
+        while True:
+            jobs = self._jobs.get()
+            by_path = {}
+            for job in jobs:
+                by_path.setdefault(job.path, []).append(job)
+
+            def done(path, result, error):
+                for job in by_path.get(path, ()):
+                    job.result = result == batch.Batch.FOUND
+                    job.error = error
+                    job.done.set()
+
+            try:
+                batch.Batch(self.jobs).run(sorted(by_path), done)
+            except Exception as e:
+                log.error("Error retrieving subtitles: %s", e,
+                          exc_info=not isinstance(e, g.LegendasError))
+                for job in jobs:
+                    if not job.done.is_set():
+                        job.error = "%s" % e
+            finally:
+                for job in jobs:
+                    job.done.set()
+
+    def serve(self):
+        """ Log in, then serve requests until interrupted """
+        from . import subtitles
+        try:
+            subtitles.get_provider()
+        except g.LegendasError as e:
+            log.warn("Could not log in, will retry on first job: %s", e)
+
+        self._worker.start()
+        log.info("Daemon listening at %s", self.path)
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+            os.remove(self.path)
+
+
+def daemon_running(path=None):
+    """ Whether a daemon is accepting connections at path """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or socket_path())
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def client(paths, wait=False, path=None):
+    """ Send paths to the daemon. Return the number of videos queued or,
+        if wait, a list of reply dicts once they are all done.
+        Raise socket.error if no daemon is running
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path or socket_path())
+    try:
+        f = sock.makefile('rwb')
+        f.write(json.dumps(dict(paths=paths, wait=wait)).encode('utf-8') + b"\n")
+        f.flush()
+        sock.shutdown(socket.SHUT_WR)
+
+        replies = [json.loads(line) for line in f]
+    finally:
+        sock.close()
+
+    for reply in replies:
+        if 'path' not in reply and reply.get('error'):
+            raise g.LegendasError(reply['error'])
+
+    if wait:
+        return replies
+    return replies[0]['queued'] if replies else 0
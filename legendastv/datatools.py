@@ -19,14 +19,28 @@
 #
 # Utilities to manipulate data like strings, lists and dicts
 
-import re
+import heapq
 import difflib
 import logging
+import collections
 
-from . import utils
+from . import g, utils
+from .normalize import clean_string
+
+# clean_string() now lives in normalize, and is exported here for callers
+__all__ = ['fields_to_int', 'difflib_similarity', 'levenshtein_similarity',
+           'ngram_similarity', 'engines', 'similarity_engine',
+           'get_similarity', 'filter_dict', 'print_dictlist',
+           'choose_top_strings', 'choose_best_string', 'choose_best_by_key',
+           'iter_find_in_dd', 'clean_string']
 
 log = logging.getLogger(__name__)
 
+try:
+    import Levenshtein  # pypi: python-Levenshtein
+except ImportError:
+    Levenshtein = None
+
 
 def fields_to_int(d, *keys):
     """ Helper function to cast several fields in a dict to int
@@ -37,20 +51,69 @@ def fields_to_int(d, *keys):
             d[key] = int(d[key])
 
 
+# Similarity engines, functions returning a float in [0,1] range representing
+# the similarity of 2 strings. Selected by 'similarity_engine' option:
+# - difflib:     difflib.SequenceMatcher ratio. Pure Python, and slow
+# - levenshtein: same ratio, computed by python-Levenshtein C extension
+# - ngram:       Dice coefficient of character bigrams. Pure Python, but
+#                much faster than difflib, and close enough for ranking
+# - auto:        levenshtein if available, ngram otherwise
+
+def difflib_similarity(text1, text2):
+    return difflib.SequenceMatcher(None, text1, text2).ratio()
+
+
+def levenshtein_similarity(text1, text2):
+    try:
+        return Levenshtein.ratio(text1, text2)
+    except TypeError:  # mixed str and unicode
+        return Levenshtein.ratio(unicode(text1), unicode(text2))
+
+
+def ngram_similarity(text1, text2):
+    if len(text1) < 2 or len(text2) < 2:
+        return 1.0 if text1 == text2 else 0.0
+    bigrams1 = set(zip(text1, text1[1:]))
+    bigrams2 = set(zip(text2, text2[1:]))
+    return 2.0 * len(bigrams1 & bigrams2) / (len(bigrams1) + len(bigrams2))
+
+
+engines = dict(
+    difflib = difflib_similarity,
+    ngram   = ngram_similarity,
+)
+if Levenshtein is not None:
+    engines['levenshtein'] = levenshtein_similarity
+
+_engine = (None, None)  # (name, function) of current engine
+
+
+def similarity_engine(name=None):
+    """ Return the similarity function named name, by default the one
+        set in options. Unknown or unavailable engines fall back to auto
+    """
+    global _engine
+    if name is None:
+        name = g.options['similarity_engine']
+        if name == _engine[0]:
+            return _engine[1]
+        _engine = (name, similarity_engine(name))
+        return _engine[1]
+
+    if name not in engines:
+        if name != 'auto':
+            log.warn("Similarity engine '%s' not available, using auto", name)
+        name = 'levenshtein' if 'levenshtein' in engines else 'ngram'
+    return engines[name]
+
+
 def get_similarity(text1, text2, ignorecase=True):
     """ Return a float in [0,1] range representing the similarity of 2 strings
     """
     if ignorecase:
         text1 = text1.lower()
         text2 = text2.lower()
-    return difflib.SequenceMatcher(None, text1, text2).ratio()
-
-
-def clean_string(text):
-    text = re.sub(r"^\[.+?]"   ,"",text)
-    text = re.sub(r"[][}{)(.,:_-]"," ",text)
-    text = re.sub(r" +"       ," ",text).strip()
-    return text
+    return similarity_engine()(text1, text2)
 
 
 def filter_dict(d, keys=[], whitelist=True):
@@ -72,29 +135,78 @@ def print_dictlist(dictlist, keys=None, whitelist=True):
                       for d in dictlist])
 
 
-def choose_best_string(reference, candidates, ignorecase=True):
-    """ Given a reference string and a list of candidate strings, return a dict
-        with the candidate most similar to the reference, its index on the list
-        and the similarity ratio (a float in [0, 1] range)
+def _length_bound(len1, len2):
+    """ Upper bound of a 2*M/T similarity ratio, M being the matching
+        characters and T the total length, as M <= the shortest length
     """
-    if ignorecase:
-        reference_lower  = reference.lower()
-        candidates_lower = [c.lower() for c in candidates]
-        result = difflib.get_close_matches(reference_lower,
-                                           candidates_lower,1, 0)[0]
+    total = len1 + len2
+    return 2.0 * min(len1, len2) / total if total else 1.0
 
-        index = candidates_lower.index(result)
-        best  = candidates[index]
-        similarity = get_similarity(reference_lower, result, False)
 
+def _chars_bound(counts, size, text):
+    """ Upper bound of a 2*M/T similarity ratio, as M <= the characters in
+        common, counts being the collections.Counter() of the other string
+        and size its length. Same as difflib.SequenceMatcher.quick_ratio()
+    """
+    total = size + len(text)
+    if not total:
+        return 1.0
+    return 2.0 * sum((counts & collections.Counter(text)).values()) / total
+
+
+def choose_top_strings(reference, candidates, k=1, ignorecase=True):
+    """ Given a reference string and a list of candidate strings, return a list
+        of up to k dicts, best first, with a candidate, its index on the list
+        and its similarity ratio to the reference. Ties favor lower indexes.
+        Candidates are scored in a single pass, skipping the ones whose
+        similarity upper bound is too low to make it into the top k
+    """
+    similarity = similarity_engine()
+    if ignorecase:
+        reference = reference.lower()
+        texts = [c.lower() for c in candidates]
     else:
-        best = difflib.get_close_matches(reference, candidates, 1, 0)[0]
-        index = candidates.index(best)
-        similarity = get_similarity(reference, best, False)
+        texts = candidates
+
+    # Ratio engines are bounded by length. Visiting candidates by decreasing
+    # bound, the first one that can not beat the k-th best ends the search.
+    # For difflib, also bounded by characters in common, slower to compute
+    # but still much faster than the ratio itself
+    order = xrange(len(texts))
+    bounds = counts = None
+    if similarity in (difflib_similarity, levenshtein_similarity):
+        size = len(reference)
+        bounds = [_length_bound(size, len(text)) for text in texts]
+        order = sorted(order, key=lambda i: -bounds[i])
+        if similarity is difflib_similarity:
+            counts = collections.Counter(reference)
+
+    top = []  # heap of (similarity, -index), worst on top
+    for i in order:
+        if len(top) >= k:
+            if bounds is not None and bounds[i] < top[0][0]:
+                break
+            if counts is not None and \
+               _chars_bound(counts, size, texts[i]) < top[0][0]:
+                continue
+        item = (similarity(reference, texts[i]), -i)
+        if len(top) < k:
+            heapq.heappush(top, item)
+        elif item > top[0]:
+            heapq.heapreplace(top, item)
+
+    return [dict(best = candidates[-i],
+                 index = -i,
+                 similarity = ratio)
+            for ratio, i in sorted(top, reverse=True)]
 
-    return dict(best = best,
-                index = index,
-                similarity = similarity)
+
+def choose_best_string(reference, candidates, ignorecase=True):
+    """ Given a reference string and a list of candidate strings, return a dict
+        with the candidate most similar to the reference, its index on the list
+        and the similarity ratio (a float in [0, 1] range)
+    """
+    return choose_top_strings(reference, candidates, 1, ignorecase)[0]
 
 
 def choose_best_by_key(reference, dictlist, key, ignorecase=True):
@@ -104,14 +216,11 @@ def choose_best_by_key(reference, dictlist, key, ignorecase=True):
         'index' = the position of the chosen dict in dictlist
         'similarity' = the similarity ratio between reference and dict[key]
     """
-    if ignorecase:
-        best = choose_best_string(reference.lower(),
-                                  [d[key].lower() for d in dictlist],
-                                  ignorecase = False)
-    else:
-        best = choose_best_string(reference, [d[key] for d in dictlist], False)
+    best = choose_best_string(reference, [d[key] for d in dictlist],
+                              ignorecase)
 
     result = dict(best = dictlist[best['index']],
+                  index = best['index'],
                   similarity = best['similarity'])
     utils.print_debug("Chosen best for '%s' in '%s': %s" % (reference, key, result))
     return result
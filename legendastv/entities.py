@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2012 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#    This file is part of Legendas.TV Subtitle Downloader
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+#
+# Compact record classes for entities such as movies and subtitles
+
+from __future__ import unicode_literals, absolute_import
+
+
+class Record(object):
+    """ Base class for compact records, with fields stored in __slots__.
+        Fields are also accessible as keys, with dict semantics, so records
+        are a drop-in replacement for the plain dicts used before:
+        an unset field is a missing key, and unknown keys raise KeyError
+        even when setting them, catching typos early.
+        Subclasses must define __slots__ with all their fields
+    """
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError("%s has no field %r" % (self.__class__.__name__,
+                                                   key))
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        try:
+            delattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def __iter__(self):
+        return (key for key in self.__slots__ if hasattr(self, key))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, dict(self.items()))
+
+    # Pickle support, as there is no __dict__
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, state):
+        self.update(state)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        return (self[key] for key in self)
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self)
+
+    def update(self, *args, **kwargs):
+        for other in args + (kwargs,):
+            if hasattr(other, 'keys'):
+                for key in other.keys():
+                    self[key] = other[key]
+            else:
+                for key, value in other:
+                    self[key] = value
+
+    def copy(self):
+        return self.__class__(self)
+
+
+class Movie(Record):
+    """ A title (movie or TV series season) as found in the website """
+    __slots__ = (
+        'id',
+        'title',
+        'title_br',
+        'thumb',
+        'year',
+        'type',
+        'season',
+        'imdb_id',
+        # Set by ranking and matching
+        'score',
+        'similarity',
+        'search',
+    )
+
+
+class Subtitle(Record):
+    """ A subtitle (or subtitle pack) as found in the website listings """
+    __slots__ = (
+        'hash',
+        'title',
+        'downloads',
+        'rating',
+        'date',
+        'user_name',
+        'release',
+        'pack',
+        'highlight',
+        'flag',
+        'language',
+        # Set by ranking
+        'score',
+    )
+
+
+class Release(Record):
+    """ A release name parsed into its fields, see release.parse_release() """
+    __slots__ = (
+        'title',
+        'year',
+        'season',
+        'episodes',
+        'episode_title',
+        'resolution',
+        'source',
+        'codec',
+        'audio',
+        'group',
+        'tags',
+    )
@@ -20,8 +20,9 @@
 
 import os
 import zipfile
-import rarfile
 import logging
+import threading
+import collections
 
 from . import datatools as dt
 
@@ -30,171 +31,190 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
 
 
+# Extractions in progress, so concurrent jobs for the same archive, such as
+# a season pack, don't list a partially extracted folder
+_extract_lock = threading.Lock()
+_extract_locks = collections.defaultdict(threading.Lock)
+
 # Most common video file extensions. NOT meant as a comprehensive list!
 # Listed here for performance reasons only,  to avoid a perhaps expensive mimetype detection
 VIDEO_EXTS = {'avi', 'm4v', 'mkv', 'mp4', 'mpg', 'mpeg', 'ogv', 'rmvb', 'wmv', 'ts'}
 
-# Extensions that are not properly detected as "video/" mimetype
-VIDEO_EXTS_EXTRA = {}
-
-try:
+# Extensions that are not properly detected as "video/" mimetype.
+# Depends on mimetype() implementation, set by _setup_mimetype()
+VIDEO_EXTS_EXTRA = None
 
-    from gi import Repository
-    if not Repository.get_default().enumerate_versions('Gio'):
-        raise ImportError
-    from gi.repository import Gio
-    log.debug("using Gio")
 
-    VIDEO_EXTS_EXTRA = {'mpv', 'ts', 'wm', 'wx', 'xvid'}
+def _setup_mimetype():
+    ''' Define mimetype() and VIDEO_EXTS_EXTRA, using Gio if available.
+        Done on first use, as importing Gio is slow
+    '''
+    global mimetype, VIDEO_EXTS_EXTRA
 
-    def mimetype(path):
-        ''' Mimetype of a file, determined by its extension and, in case of
-            extensionless files, its initial content (1KB read).
-            Return 'application/octet-stream' for unknown types and non-files:
-            directories, broken symlinks, path not found, access denied.
-        '''
-        mime = Gio.content_type_get_mime_type(Gio.content_type_guess(filename=path, data=None)[0])
-        if extension(path):
-            return mime
+    try:
 
-        try:
-            with open(path, 'rb') as f:
-                return Gio.content_type_guess(filename=None, data=f.read(1024))[0]
-        except IOError:
-            return mime  # most likely access denied or file not found
-
-    # .60d    application/octet-stream
-    # .ajp    application/octet-stream
-    # .asx    audio/x-ms-asx
-    # .avchd    application/octet-stream
-    # .bik    application/octet-stream
-    # .bin    application/octet-stream
-    # .bix    application/octet-stream
-    # .box    application/octet-stream
-    # .cam    application/octet-stream
-    # .cue    application/x-cue
-    # .dat    application/octet-stream
-    # .dif    application/octet-stream
-    # .dl    application/octet-stream
-    # .dmf    application/octet-stream
-    # .dvr-ms    application/octet-stream
-    # .evo    application/octet-stream
-    # .flic    application/octet-stream
-    # .flx    application/octet-stream
-    # .gl    application/octet-stream
-    # .gvi    application/octet-stream
-    # .gvp    text/x-google-video-pointer
-    # .h264    application/octet-stream
-    # .lsf    application/octet-stream
-    # .lsx    application/octet-stream
-    # .m1v    application/octet-stream
-    # .m2p    application/octet-stream
-    # .m2v    application/octet-stream
-    # .m4e    application/octet-stream
-    # .mjp    application/octet-stream
-    # .mjpeg    application/octet-stream
-    # .mjpg    application/octet-stream
-    # .movhd    application/octet-stream
-    # .movx    application/octet-stream
-    # .mpa    application/octet-stream
-    # .mpv    application/octet-stream
-    # .mpv2    application/octet-stream
-    # .mxf    application/mxf
-    # .nut    application/octet-stream
-    # .ogg    audio/ogg
-    # .omf    application/octet-stream
-    # .ps    application/postscript
-    # .ram    application/ram
-    # .rm    application/vnd.rn-realmedia
-    # .rmvb    application/vnd.rn-realmedia
-    # .swf    application/x-shockwave-flash
-    # .ts    text/vnd.trolltech.linguist
-    # .vfw    application/octet-stream
-    # .vid    application/octet-stream
-    # .video    application/octet-stream
-    # .vro    application/octet-stream
-    # .wm    application/octet-stream
-    # .wmx    audio/x-ms-asx
-    # .wrap    application/octet-stream
-    # .wvx    audio/x-ms-asx
-    # .wx    application/octet-stream
-    # .x264    application/octet-stream
-    # .xvid    application/octet-stream
-
-
-except ImportError:
-
-    import mimetypes
-    log.debug("using Lib/mimetypes")
-
-    mimetypes.init()
-
-    VIDEO_EXTS_EXTRA = {'divx', 'm2ts', 'mpv', 'ogm', 'rmvb', 'ts', 'wm', 'wx', 'xvid'}
-
-    def mimetype(path):
-        ''' Mimetype of a file, determined by its extension.
-            Return 'application/octet-stream' for unknown types and non-files:
-            directories, broken symlinks, path not found, access denied.
-        '''
-        return mimetypes.guess_type(path, strict=False)[0] or "application/octet-stream"
-
-    # .3g2    None
-    # .3gp2    None
-    # .3gpp    None
-    # .60d    None
-    # .ajp    None
-    # .avchd    None
-    # .bik    None
-    # .bin    application/octet-stream
-    # .bix    None
-    # .box    None
-    # .cam    None
-    # .cue    None
-    # .dat    application/x-ns-proxy-autoconfig
-    # .divx    None
-    # .dmf    None
-    # .dvr-ms    None
-    # .evo    None
-    # .flc    None
-    # .flic    None
-    # .flx    None
-    # .gvi    None
-    # .gvp    None
-    # .h264    None
-    # .m2p    None
-    # .m2ts    None
-    # .m2v    None
-    # .m4e    None
-    # .m4v    None
-    # .mjp    None
-    # .mjpeg    None
-    # .mjpg    None
-    # .moov    None
-    # .movhd    None
-    # .movx    None
-    # .mpv2    None
-    # .mxf    application/mxf
-    # .nsv    None
-    # .nut    None
-    # .ogg    audio/ogg
-    # .ogm    None
-    # .omf    None
-    # .ps    application/postscript
-    # .ram    audio/x-pn-realaudio
-    # .rm    audio/x-pn-realaudio
-    # .rmvb    None
-    # .swf    application/x-shockwave-flash
-    # .vfw    None
-    # .vid    None
-    # .video    None
-    # .viv    None
-    # .vivo    None
-    # .vob    None
-    # .vro    None
-    # .wrap    None
-    # .wx    None
-    # .x264    None
-    # .xvid    None
+        from gi import Repository
+        if not Repository.get_default().enumerate_versions('Gio'):
+            raise ImportError
+        from gi.repository import Gio
+        log.debug("using Gio")
+
+        VIDEO_EXTS_EXTRA = {'mpv', 'ts', 'wm', 'wx', 'xvid'}
+
+        def mimetype(path):
+            ''' Mimetype of a file, determined by its extension and, in case of
+                extensionless files, its initial content (1KB read).
+                Return 'application/octet-stream' for unknown types and non-files:
+                directories, broken symlinks, path not found, access denied.
+            '''
+            mime = Gio.content_type_get_mime_type(Gio.content_type_guess(filename=path, data=None)[0])
+            if extension(path):
+                return mime
+
+            try:
+                with open(path, 'rb') as f:
+                    return Gio.content_type_guess(filename=None, data=f.read(1024))[0]
+            except IOError:
+                return mime  # most likely access denied or file not found
+
+        # .60d    application/octet-stream
+        # .ajp    application/octet-stream
+        # .asx    audio/x-ms-asx
+        # .avchd    application/octet-stream
+        # .bik    application/octet-stream
+        # .bin    application/octet-stream
+        # .bix    application/octet-stream
+        # .box    application/octet-stream
+        # .cam    application/octet-stream
+        # .cue    application/x-cue
+        # .dat    application/octet-stream
+        # .dif    application/octet-stream
+        # .dl    application/octet-stream
+        # .dmf    application/octet-stream
+        # .dvr-ms    application/octet-stream
+        # .evo    application/octet-stream
+        # .flic    application/octet-stream
+        # .flx    application/octet-stream
+        # .gl    application/octet-stream
+        # .gvi    application/octet-stream
+        # .gvp    text/x-google-video-pointer
+        # .h264    application/octet-stream
+        # .lsf    application/octet-stream
+        # .lsx    application/octet-stream
+        # .m1v    application/octet-stream
+        # .m2p    application/octet-stream
+        # .m2v    application/octet-stream
+        # .m4e    application/octet-stream
+        # .mjp    application/octet-stream
+        # .mjpeg    application/octet-stream
+        # .mjpg    application/octet-stream
+        # .movhd    application/octet-stream
+        # .movx    application/octet-stream
+        # .mpa    application/octet-stream
+        # .mpv    application/octet-stream
+        # .mpv2    application/octet-stream
+        # .mxf    application/mxf
+        # .nut    application/octet-stream
+        # .ogg    audio/ogg
+        # .omf    application/octet-stream
+        # .ps    application/postscript
+        # .ram    application/ram
+        # .rm    application/vnd.rn-realmedia
+        # .rmvb    application/vnd.rn-realmedia
+        # .swf    application/x-shockwave-flash
+        # .ts    text/vnd.trolltech.linguist
+        # .vfw    application/octet-stream
+        # .vid    application/octet-stream
+        # .video    application/octet-stream
+        # .vro    application/octet-stream
+        # .wm    application/octet-stream
+        # .wmx    audio/x-ms-asx
+        # .wrap    application/octet-stream
+        # .wvx    audio/x-ms-asx
+        # .wx    application/octet-stream
+        # .x264    application/octet-stream
+        # .xvid    application/octet-stream
+
+
+    except ImportError:
+
+        import mimetypes
+        log.debug("using Lib/mimetypes")
+
+        mimetypes.init()
+
+        VIDEO_EXTS_EXTRA = {'divx', 'm2ts', 'mpv', 'ogm', 'rmvb', 'ts', 'wm', 'wx', 'xvid'}
+
+        def mimetype(path):
+            ''' Mimetype of a file, determined by its extension.
+                Return 'application/octet-stream' for unknown types and non-files:
+                directories, broken symlinks, path not found, access denied.
+            '''
+            return mimetypes.guess_type(path, strict=False)[0] or "application/octet-stream"
+
+        # .3g2    None
+        # .3gp2    None
+        # .3gpp    None
+        # .60d    None
+        # .ajp    None
+        # .avchd    None
+        # .bik    None
+        # .bin    application/octet-stream
+        # .bix    None
+        # .box    None
+        # .cam    None
+        # .cue    None
+        # .dat    application/x-ns-proxy-autoconfig
+        # .divx    None
+        # .dmf    None
+        # .dvr-ms    None
+        # .evo    None
+        # .flc    None
+        # .flic    None
+        # .flx    None
+        # .gvi    None
+        # .gvp    None
+        # .h264    None
+        # .m2p    None
+        # .m2ts    None
+        # .m2v    None
+        # .m4e    None
+        # .m4v    None
+        # .mjp    None
+        # .mjpeg    None
+        # .mjpg    None
+        # .moov    None
+        # .movhd    None
+        # .movx    None
+        # .mpv2    None
+        # .mxf    application/mxf
+        # .nsv    None
+        # .nut    None
+        # .ogg    audio/ogg
+        # .ogm    None
+        # .omf    None
+        # .ps    application/postscript
+        # .ram    audio/x-pn-realaudio
+        # .rm    audio/x-pn-realaudio
+        # .rmvb    None
+        # .swf    application/x-shockwave-flash
+        # .vfw    None
+        # .vid    None
+        # .video    None
+        # .viv    None
+        # .vivo    None
+        # .vob    None
+        # .vro    None
+        # .wrap    None
+        # .wx    None
+        # .x264    None
+        # .xvid    None
+
+
+def mimetype(path):
+    ''' Mimetype of a file. Replaced by the actual implementation on first call '''
+    _setup_mimetype()
+    return mimetype(path)
 
 
 def is_video(path):
@@ -202,7 +222,12 @@ def is_video(path):
         Determined by both file extension and its mimetype.
     '''
     ext = extension(path)
-    if ext in VIDEO_EXTS or ext in VIDEO_EXTS_EXTRA:
+    if ext in VIDEO_EXTS:
+        return True
+
+    if VIDEO_EXTS_EXTRA is None:
+        _setup_mimetype()
+    if ext in VIDEO_EXTS_EXTRA:
         return True
 
     mimes = ['x-ms-asx',                                   # MS Windows Media Player - asx, wmx, wvx
@@ -243,9 +268,12 @@ def extract_archive(archive, path=None, extlist=[], keep=True, overwrite=False):
     if path is None:
         path = os.path.splitext(archive)[0]
 
-    if overwrite or not os.path.exists(path):
-        safemakedirs(path)
-        af.extractall(path)
+    with _extract_lock:
+        lock = _extract_locks[path]
+    with lock:
+        if overwrite or not os.path.exists(path):
+            safemakedirs(path)
+            af.extractall(path)
 
     if isinstance(extlist, basestring):
         extlist = extlist.split(",")
@@ -285,6 +313,8 @@ def ArchiveFile(filename):
         return: a RarFile or ZipFile instance (or None), depending on
                 <filename> content
     """
+    import rarfile  # slow to import, so only when needed
+
     if   rarfile.is_rarfile(filename):
         return rarfile.RarFile(filename, mode='r')
 
@@ -295,6 +325,25 @@ def ArchiveFile(filename):
         return None
 
 
+def is_archive(filename):
+    """ Return True if filename is a readable zip or rar archive.
+        Useful as an integrity check, as truncated archives fail to open
+    """
+    import rarfile
+
+    try:
+        af = ArchiveFile(filename)
+    except (rarfile.Error, zipfile.BadZipfile, IOError) as e:
+        log.debug("Invalid archive '%s': %s", filename, e)
+        return False
+
+    if not af:
+        return False
+
+    af.close()
+    return True
+
+
 if __name__ == '__main__':
     import sys
     if len(sys.argv) < 2:
@@ -67,6 +67,20 @@ options = {
     'similarity'    : 0.7,
     'notifications' : True,
     'language'      : "pb",
+    'prefetch_pages': 2,
+    'stop_score'    : 8.5,
+    'max_pages'     : 0,
+    'rate_limit'    : 5.0,
+    'retries'       : 3,
+    'timeout'       : 30,
+    'deadline'      : 300,
+    'similarity_engine' : "auto",
+    'vectorize'     : False,
+    'jobs'          : 1,
+    'cpu_jobs'      : 0,
+    'provider_jobs' : 4,
+    'titles_ttl'    : 7*24*60*60,
+    'listings_ttl'  : 6*60*60,
 }
 
 mapping = {
@@ -0,0 +1,826 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2012 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#    This file is part of Legendas.TV Subtitle Downloader
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+#
+# HTTP transport helpers: persistent connection pool for urllib2,
+# compressed responses, an on-disk response cache, rate limiting and
+# retries, deadlines and circuit breakers, background fetching
+
+from __future__ import unicode_literals, absolute_import, division
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import errno
+import random
+import socket
+import hashlib
+import httplib
+import urllib2
+import urlparse
+import logging
+import threading
+import contextlib
+import Queue
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from . import g
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    """ Thread-safe pool of persistent httplib connections, keyed by
+        (scheme, host). At most maxsize connections per host are open at any
+        time, either idle in the pool or checked out by a request.
+        stats counts created, reused and discarded connections, so one can
+        check the pool is actually doing its job
+    """
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.stats = dict(requests=0, created=0, reused=0, discarded=0, waits=0)
+        self._idle = {}    # key -> list of idle connections, last used on top
+        self._active = {}  # key -> number of connections checked out
+        self._cond = threading.Condition()
+
+    def acquire(self, key, factory):
+        """ Return a 2-tuple (connection, reused) for key, either an idle one
+            or a new one created by factory(). Blocks while the host limit
+            is reached
+        """
+        with self._cond:
+            self.stats['requests'] += 1
+            while (not self._idle.get(key) and
+                   self._active.get(key, 0) >= self.maxsize):
+                self.stats['waits'] += 1
+                self._cond.wait()
+
+            self._active[key] = self._active.get(key, 0) + 1
+            if self._idle.get(key):
+                self.stats['reused'] += 1
+                return self._idle[key].pop(), True
+
+            self.stats['created'] += 1
+
+        try:
+            return factory(), False
+        except Exception:
+            self._checkin(key)
+            raise
+
+    def release(self, key, conn, reusable=True):
+        """ Give back a connection. If not reusable, it's closed and dropped """
+        with self._cond:
+            if reusable:
+                self._idle.setdefault(key, []).append(conn)
+            else:
+                self.stats['discarded'] += 1
+            self._checkin(key)
+
+        if not reusable:
+            conn.close()
+
+    def clear(self):
+        """ Close all idle connections """
+        with self._cond:
+            idle, self._idle = self._idle, {}
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+    def _checkin(self, key):
+        with self._cond:
+            self._active[key] -= 1
+            self._cond.notify()
+
+
+class _PooledSocket(object):
+    """ Minimal socket-like view of an httplib response, to be wrapped by
+        socket._fileobject just like urllib2 does. Returns the connection to
+        the pool once the body is fully read, or drops it if closed early
+    """
+    def __init__(self, response, pool, key, conn):
+        self._response = response
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+
+    def recv(self, amt):
+        data = self._response.read(amt)
+        if not data or self._response.isclosed():
+            self._finish()
+        return data
+
+    def close(self):
+        self._finish()
+
+    def _finish(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        reusable = self._response.isclosed() and not self._response.will_close
+        if not reusable:
+            self._response.close()
+        self._pool.release(self._key, conn, reusable)
+
+
+class _KeepAliveMixin:
+    """ Replacement for urllib2.AbstractHTTPHandler.do_open that sends requests
+        over pooled persistent connections instead of opening a new one and
+        sending 'Connection: close' for every request.
+        Old-style class, just like urllib2 handlers
+    """
+    def do_pooled_open(self, http_class, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        key = (req.get_type(), host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items()
+                       if k not in headers)
+        headers = dict((name.title(), val) for name, val in headers.items())
+        headers['Connection'] = 'keep-alive'
+
+        def factory():
+            return http_class(host, timeout=req.timeout)
+
+        # A reused connection may have been silently dropped by the server
+        # while idle. In that case retry once with a fresh connection.
+        # A timeout is not a stale connection, but a slow server
+        while True:
+            conn, reused = self.pool.acquire(key, factory)
+            if reused and conn.timeout != req.timeout:
+                conn.timeout = req.timeout
+                if conn.sock:
+                    conn.sock.settimeout(req.timeout)
+            try:
+                conn.request(req.get_method(), req.get_selector(),
+                             req.data, headers)
+                r = conn.getresponse(buffering=True)
+            except (socket.error, httplib.HTTPException) as e:
+                self.pool.release(key, conn, reusable=False)
+                if reused and not isinstance(e, socket.timeout):
+                    log.debug("Stale connection to %s, retrying: %r", host, e)
+                    continue
+                # Like urllib2, wrap socket errors only, so HTTP protocol
+                # errors such as BadStatusLine reach callers as they are
+                if isinstance(e, socket.error):
+                    raise urllib2.URLError(e)
+                raise
+            break
+
+        fp = socket._fileobject(_PooledSocket(r, self.pool, key, conn),
+                                close=True)
+        resp = urllib2.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+
+class KeepAliveHandler(_KeepAliveMixin, urllib2.HTTPHandler):
+    def __init__(self, pool=None, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool or ConnectionPool()
+
+    def http_open(self, req):
+        return self.do_pooled_open(httplib.HTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(_KeepAliveMixin, urllib2.HTTPSHandler):
+    def __init__(self, pool=None, debuglevel=0):
+        urllib2.HTTPSHandler.__init__(self, debuglevel)
+        self.pool = pool or ConnectionPool()
+
+    def https_open(self, req):
+        return self.do_pooled_open(httplib.HTTPSConnection, req)
+
+
+# Content-Encoding values understood by Decompressor
+ENCODINGS = ('gzip', 'x-gzip', 'deflate')
+ACCEPT_ENCODING = "gzip, deflate"
+
+
+class Decompressor(object):
+    """ Incremental decoder for a gzip or deflate encoded HTTP body.
+        'deflate' should be zlib-wrapped, but some servers send it raw,
+        so both are accepted
+    """
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'deflate':
+            self._decoder = zlib.decompressobj()
+        else:
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._first = True
+
+    def decompress(self, data):
+        if self._first and data:
+            self._first = False
+            if self.encoding == 'deflate':
+                try:
+                    return self._decoder.decompress(data)
+                except zlib.error:
+                    self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decoder.decompress(data)
+
+    def flush(self):
+        return self._decoder.flush()
+
+
+class _DecodedSocket(object):
+    """ Socket-like view of an encoded response body, decoded on the fly,
+        to be wrapped by socket._fileobject. Counts bytes read and decoded
+        in stats
+    """
+    def __init__(self, fp, encoding, stats):
+        self._fp = fp
+        self._decompressor = Decompressor(encoding)
+        self._stats = stats
+        self._buffer = b""  # decoded data beyond last recv() size
+        self._done = False
+
+    def recv(self, amt):
+        while not self._buffer and not self._done:
+            data = self._fp.read(amt)
+            if data:
+                self._buffer = self._decompressor.decompress(data)
+            else:
+                self._buffer = self._decompressor.flush()
+                self._done = True
+            self._stats['received'] += len(data)
+            self._stats['decoded'] += len(self._buffer)
+        output, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return output
+
+    def close(self):
+        self._fp.close()
+
+
+class DecompressionProcessor(urllib2.BaseHandler):
+    """ Ask for gzip or deflate encoded responses, unless the request sets
+        its own Accept-Encoding, and transparently decode them while they
+        are read. Decoded responses lose their Content-Encoding and
+        Content-Length headers, as length no longer matches.
+        stats counts encoded responses, and bytes received and decoded
+    """
+    def __init__(self):
+        self.stats = dict(responses=0, encoded=0, received=0, decoded=0)
+
+    def http_request(self, req):
+        if not req.has_header('Accept-encoding'):
+            req.add_unredirected_header('Accept-Encoding', ACCEPT_ENCODING)
+        return req
+
+    def http_response(self, req, resp):
+        self.stats['responses'] += 1
+        headers = resp.info()
+        encoding = headers.getheader('Content-Encoding', "").strip().lower()
+        if encoding not in ENCODINGS:
+            return resp
+
+        self.stats['encoded'] += 1
+        del headers['Content-Encoding']
+        if 'Content-Length' in headers:
+            del headers['Content-Length']
+        fp = socket._fileobject(_DecodedSocket(resp, encoding, self.stats),
+                                close=True)
+        decoded = urllib2.addinfourl(fp, headers, resp.geturl(),
+                                     resp.getcode())
+        decoded.msg = resp.msg
+        return decoded
+
+    https_request = http_request
+    https_response = http_response
+
+
+# HTTP status codes and socket errors worth a retry
+TRANSIENT_CODES = (500,  # Internal Server Error
+                   502,  # Bad Gateway
+                   503,  # Service Unavailable
+                   504,  # Gateway Timeout
+                   513,  # Legendas.TV overloaded
+                   )
+TRANSIENT_ERRNOS = (errno.ECONNRESET, errno.ECONNREFUSED, errno.ECONNABORTED,
+                    errno.ETIMEDOUT, errno.EPIPE)
+
+
+def is_transient(e):
+    """ Whether an exception raised by urllib2 is a transient error,
+        so the request can be retried
+    """
+    if isinstance(e, urllib2.HTTPError):
+        return e.code in TRANSIENT_CODES
+
+    if isinstance(e, urllib2.URLError):
+        e = e.reason
+
+    if isinstance(e, (httplib.HTTPException, socket.timeout)):
+        return True
+
+    if isinstance(e, socket.error):
+        return e.errno in TRANSIENT_ERRNOS
+
+    return False
+
+
+def backoff(attempt, base=0.5, cap=30):
+    """ Delay in seconds before retry number attempt (starting at 0):
+        exponential, capped, with random jitter so concurrent clients don't
+        retry in lockstep
+    """
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class _Host(object):
+    __slots__ = ('tokens', 'stamp', 'limit', 'active')
+
+    def __init__(self, tokens, limit):
+        self.tokens = tokens
+        self.stamp = time.time()
+        self.limit = limit
+        self.active = 0
+
+
+class RateLimiter(object):
+    """ Client-side, per-host request rate limiter.
+        A token bucket allows rate requests per second, in bursts of up to
+        burst requests, with no limit if rate is 0. Concurrent requests are
+        limited by an AIMD scheme: the limit grows by 1 after each limit
+        successful requests (additive increase), and is halved after a
+        throttled or failed one (multiplicative decrease).
+        stats has the request, throttle and retry counters, and the total
+        time spent waiting for the limits
+    """
+    def __init__(self, rate=0, burst=1, concurrency=4,
+                 min_concurrency=1, max_concurrency=16):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.concurrency = concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.stats = dict(requests=0, throttled=0, retries=0, waited=0.0)
+        self._hosts = {}
+        self._cond = threading.Condition()
+
+    def acquire(self, host):
+        """ Block until a request to host is allowed """
+        start = time.time()
+        with self._cond:
+            h = self._hosts.get(host)
+            if h is None:
+                h = self._hosts[host] = _Host(self.burst, self.concurrency)
+
+            while h.active >= int(h.limit):
+                self._cond.wait()
+            h.active += 1
+
+            while self.rate:
+                now = time.time()
+                h.tokens = min(self.burst, h.tokens + (now - h.stamp) * self.rate)
+                h.stamp = now
+                if h.tokens >= 1:
+                    h.tokens -= 1
+                    break
+                self._cond.wait((1 - h.tokens) / self.rate)
+
+            self.stats['requests'] += 1
+            self.stats['waited'] += time.time() - start
+
+    def release(self, host, throttled=False):
+        """ Finish a request to host, adapting its concurrency limit """
+        with self._cond:
+            h = self._hosts[host]
+            h.active -= 1
+            if throttled:
+                self.stats['throttled'] += 1
+                h.limit = max(self.min_concurrency, h.limit / 2)
+                h.tokens = 0
+            else:
+                h.limit = min(self.max_concurrency, h.limit + 1 / h.limit)
+            self._cond.notify_all()
+
+    def metrics(self):
+        """ Counters from stats, plus the current concurrency limit per host """
+        with self._cond:
+            metrics = dict(self.stats)
+            metrics['limits'] = dict((host, round(h.limit, 2))
+                                     for host, h in self._hosts.iteritems())
+        return metrics
+
+
+class DeadlineExceeded(g.LegendasError):
+    pass
+
+
+class CircuitOpenError(g.LegendasError):
+    pass
+
+
+# Deadline of current thread, an absolute time.time() or None
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """ Context manager setting an overall time limit, in seconds, for all
+        requests made in its block by current thread. Nested deadlines can
+        only shorten an outer one. No limit if seconds is 0 or None, and
+        already expired if negative
+    """
+    previous = getattr(_local, 'deadline', None)
+    expires = previous
+    if seconds:
+        expires = time.time() + seconds
+        if previous is not None:
+            expires = min(expires, previous)
+    _local.deadline = expires
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def with_deadline(func):
+    """ Wrap func so it runs under the deadline of current thread, even when
+        called from another thread, such as a ThreadPool worker
+    """
+    expires = getattr(_local, 'deadline', None)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'deadline', None)
+        _local.deadline = expires
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.deadline = previous
+    return wrapper
+
+
+def remaining():
+    """ Seconds left until current deadline, or None if there is none """
+    expires = getattr(_local, 'deadline', None)
+    if expires is None:
+        return None
+    return expires - time.time()
+
+
+def check_deadline():
+    """ Raise DeadlineExceeded if current deadline has passed """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("Time limit exceeded, giving up")
+
+
+def timeout(default):
+    """ Timeout for a blocking operation: default, capped by the time left
+        until current deadline. Raise DeadlineExceeded if it has passed
+    """
+    check_deadline()
+    left = remaining()
+    if left is None:
+        return default
+    return min(default, left) if default else left
+
+
+class CircuitBreaker(object):
+    """ Fail fast while a service is down. After threshold consecutive
+        failures the circuit opens, and before() raises CircuitOpenError
+        right away for the next reset seconds. Then a single trial request
+        is let through: success closes the circuit, failure opens it again
+    """
+    def __init__(self, name, threshold=5, reset=60):
+        self.name = name
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None  # time.time() the circuit was opened
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before(self):
+        """ Check whether a request is allowed. Return whether it is the
+            trial request, which must end with success(), failure() or,
+            if it never got an answer either way, release()
+        """
+        with self._lock:
+            if self.opened is None:
+                return False
+            wait = self.opened + self.reset - time.time()
+            if self._trial or wait > 0:
+                raise CircuitOpenError("%s seems to be down, not trying again"
+                                       " for %d seconds" %
+                                       (self.name, max(wait, 0)))
+            self._trial = True
+            return True
+
+    def release(self):
+        """ End a trial request that neither succeeded nor failed, such as
+            one cut short by a deadline, so the next request is a new trial
+        """
+        with self._lock:
+            self._trial = False
+
+    def success(self):
+        with self._lock:
+            if self.opened is not None:
+                log.info("%s is back", self.name)
+            self.failures = 0
+            self.opened = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.opened is None and self.failures < self.threshold:
+                return
+            if self.opened is None:
+                log.warn("%s failed %d times in a row, pausing requests for"
+                         " %d seconds", self.name, self.failures, self.reset)
+            self.opened = time.time()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """ The CircuitBreaker for a service name, shared by all its clients """
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def read_ahead(iterable, size):
+    """ Iterate over iterable in a background thread, up to size items ahead
+        of the consumer, under the deadline of current thread. An exception
+        raised by iterable is raised to the consumer in its place. Once the
+        consumer stops, no more items are read
+    """
+    items = Queue.Queue()
+    slots = threading.Semaphore(size)
+    stop = threading.Event()
+    end = object()
+
+    def read():
+        iterator = iter(iterable)
+        while True:
+            slots.acquire()
+            if stop.is_set():
+                return
+            try:
+                item = next(iterator)
+            except StopIteration:
+                items.put((end, None))
+                return
+            except Exception:
+                items.put((end, sys.exc_info()))
+                return
+            items.put((item, None))
+
+    reader = threading.Thread(target=with_deadline(read))
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is end:
+                if error:
+                    raise error[0], error[1], error[2]
+                return
+            slots.release()
+            yield item
+    finally:
+        stop.set()
+        slots.release()
+
+
+class FetchQueue(object):
+    """ Background queue of fetch(*args) calls, such as downloads of images,
+        run by up to workers threads, started on first use.
+        Calls are deduplicated by key: submitting a key already queued,
+        running or done returns its existing AsyncResult. A failed call is
+        logged and forgotten, so it can be submitted again
+    """
+    def __init__(self, fetch, workers=2):
+        self.fetch = fetch
+        self.workers = workers
+        self.stats = dict(submitted=0, deduplicated=0, failed=0)
+        self._results = {}  # key -> AsyncResult
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def submit(self, key, *args):
+        """ Queue fetch(*args) unless key was already submitted.
+            Return an AsyncResult for its return value, None on failure
+        """
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self.stats['deduplicated'] += 1
+                return result
+
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            self.stats['submitted'] += 1
+            result = self._pool.apply_async(self._run, (key,) + args)
+            self._results[key] = result
+            return result
+
+    def _run(self, key, *args):
+        try:
+            return self.fetch(*args)
+        except Exception as e:
+            log.warn("Error fetching %s: %s", key, e)
+            with self._lock:
+                self.stats['failed'] += 1
+                self._results.pop(key, None)
+
+    def close(self):
+        """ Wait for queued calls and release the workers """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+class ResponseCache(object):
+    """ On-disk cache of HTTP responses, one zlib-compressed file per URL.
+        ttls is a list of (regex, seconds) matched against the URL path,
+        first match wins. URLs not matching any are never cached.
+        Total size is bounded by maxsize bytes, evicting the least recently
+        used entries first (file mtime is used as access time).
+        Entries keep ETag and Last-Modified headers, so stale ones can be
+        revalidated with a conditional request instead of downloaded again
+    """
+    # Response headers kept in cache
+    headers = ('content-type', 'etag', 'last-modified')
+
+    def __init__(self, path, ttls=(), maxsize=32*2**20):
+        self.path = path
+        self.ttls = [(re.compile(regex), ttl) for regex, ttl in ttls]
+        self.maxsize = maxsize
+        self.stats = dict(hits=0, misses=0, revalidated=0, stored=0, evicted=0)
+        self._size = None  # lazily computed
+        self._lock = threading.Lock()
+
+    def ttl(self, url):
+        """ Time-to-live for an URL, None if it should not be cached """
+        path = urlparse.urlsplit(url).path
+        for regex, ttl in self.ttls:
+            if regex.match(path):
+                return ttl
+
+    def lookup(self, url):
+        """ Return a 2-tuple (entry, fresh) for url. entry is None if not in
+            cache, or a dict with keys url, time, headers and body
+        """
+        ttl = self.ttl(url)
+        filename = self._filename(url)
+        try:
+            with open(filename, 'rb') as f:
+                data = zlib.decompress(f.read())
+            meta, _, body = data.partition(b'\n')
+            entry = json.loads(meta)
+            entry['body'] = body
+        except (IOError, OSError, zlib.error, ValueError):
+            entry = None
+
+        # Mind the (unlikely) hash collisions
+        if entry is None or entry.get('url') != url:
+            self._count('misses')
+            return None, False
+
+        try:
+            os.utime(filename, None)  # LRU bookkeeping
+        except OSError:
+            pass
+
+        fresh = ttl is not None and entry['time'] > time.time() - ttl
+        self._count('hits' if fresh else 'misses')
+        return entry, fresh
+
+    def _count(self, stat):
+        # Lookups run concurrently, from searches and background fetches
+        with self._lock:
+            self.stats[stat] += 1
+
+    def validators(self, entry):
+        """ Conditional request headers to revalidate a cache entry """
+        headers = {}
+        if entry['headers'].get('etag'):
+            headers['If-None-Match'] = entry['headers']['etag']
+        if entry['headers'].get('last-modified'):
+            headers['If-Modified-Since'] = entry['headers']['last-modified']
+        return headers
+
+    def store(self, url, response, body):
+        """ Save a response body in cache and return its entry.
+            response may also be a previous entry, when revalidated
+        """
+        if isinstance(response, dict):
+            headers, realurl = response['headers'], response['realurl']
+        else:
+            info = response.info()
+            headers = dict((k, info.getheader(k)) for k in self.headers
+                           if info.getheader(k) is not None)
+            realurl = response.geturl()
+
+        entry = dict(url=url, realurl=realurl, time=time.time(),
+                     headers=headers)
+        data = zlib.compress(json.dumps(entry).encode('utf-8') + b'\n' + body)
+        entry['body'] = body
+
+        filename = self._filename(url)
+        tempname = "%s.%d.tmp" % (filename, threading.current_thread().ident)
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0700)
+            oldsize = os.path.getsize(filename) if os.path.exists(filename) else 0
+            with open(tempname, 'wb') as f:
+                f.write(data)
+            os.rename(tempname, filename)
+        except (IOError, OSError) as e:
+            log.warn("Could not save %s to cache: %s", url, e)
+            return entry
+
+        with self._lock:
+            self.stats['stored'] += 1
+            if self._size is not None:
+                self._size += len(data) - oldsize
+        self._evict()
+        return entry
+
+    def revalidated(self, url, entry):
+        """ Renew a cache entry the server confirmed is unchanged, and
+            return it, see store()
+        """
+        self._count('revalidated')
+        return self.store(url, entry, entry['body'])
+
+    def response(self, entry):
+        """ Build an urllib2-like response from a cache entry """
+        headers = httplib.HTTPMessage(StringIO("".join(
+            "%s: %s\r\n" % (k, v)
+            for k, v in entry['headers'].iteritems()).encode('latin-1')))
+        response = urllib2.addinfourl(StringIO(entry['body']), headers,
+                                      entry['realurl'], code=200)
+        response.msg = "OK"
+        return response
+
+    def _filename(self, url):
+        return os.path.join(self.path,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def _evict(self):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            if self._size <= self.maxsize:
+                return
+
+            for _, size, filename in sorted(self._entries()):
+                if self._size <= self.maxsize:
+                    break
+                try:
+                    os.remove(filename)
+                except OSError:
+                    continue
+                self._size -= size
+                self.stats['evicted'] += 1
+
+    def _entries(self):
+        """ Yield (mtime, size, filename) for every cache file """
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            filename = os.path.join(self.path, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            yield st.st_mtime, st.st_size, filename
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2012 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#    This file is part of Legendas.TV Subtitle Downloader
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+#
+# Normalization of titles and release names for searching and comparison.
+# Patterns are precompiled and combined, and results memoized, as the same
+# titles and releases are normalized over and over again while ranking
+
+import re
+import functools
+
+
+def memoize(maxsize=4096):
+    """ Decorator memoizing a function of a single hashable argument.
+        Bounded and approximately least recently used: results go to a young
+        generation, and when it reaches maxsize it replaces the old one, the
+        previous old generation being dropped. Hits in the old generation
+        move back to the young one. Lookups are plain dict operations, atomic
+        and much cheaper than an OrderedDict and a lock
+    """
+    def decorator(func):
+        generations = [{}, {}]  # young, old
+
+        @functools.wraps(func)
+        def wrapper(arg):
+            young = generations[0]
+            try:
+                return young[arg]
+            except KeyError:
+                pass
+
+            try:
+                result = generations[1][arg]
+            except KeyError:
+                result = func(arg)
+
+            if len(young) >= maxsize:
+                young = {}
+                generations[:] = [young, generations[0]]
+            young[arg] = result
+            return result
+
+        def cache_clear():
+            generations[:] = [{}, {}]
+
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
+
+
+# A leading [tag], or a run of separators and spaces
+_re_clean = re.compile(r"^\[.+?]|[][}{)(.,:_ -]+")
+
+
+@memoize()
+def clean_string(text):
+    """ Remove a leading [tag], replace separators like dots and dashes with
+        a single space, and strip
+    """
+    return _re_clean.sub(" ", text).strip()
+
+
+@memoize()
+def normalize(text):
+    """ clean_string(), lowercase. The form strings are compared in """
+    return _re_clean.sub(" ", text).strip().lower()
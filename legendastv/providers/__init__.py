@@ -20,25 +20,40 @@
 
 from __future__ import absolute_import
 
-__all__ = ['providers']
+import threading
 
+__all__ = ['providers', 'get_providers']
+
+# Populated by get_providers()
 providers = []
 
+_lock = threading.Lock()
+
 
 class Provider(object):
     pass
 
 
 def _setup_providers():
+    """ List provider modules, without importing them """
     import pkgutil
 
     for importer, modname, ispkg in pkgutil.iter_modules(__path__):
         if not ispkg:
             __all__.append(modname)
-            fullname = "%s.%s" % (__name__, modname)
-            __import__(fullname, globals, locals)
 
-    providers.extend(Provider.__subclasses__())
+
+def get_providers():
+    """ Return the list of Provider classes. Their modules are only imported
+        on first call, as some have slow dependencies
+    """
+    with _lock:
+        if not providers:
+            for modname in __all__:
+                if modname not in ('providers', 'get_providers'):
+                    __import__("%s.%s" % (__name__, modname))
+            providers.extend(Provider.__subclasses__())
+        return providers
 
 
 _setup_providers()
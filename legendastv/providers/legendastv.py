@@ -27,19 +27,76 @@ import urllib
 import urllib2
 import urlparse
 import operator
+import heapq
 import logging
 import json
 import time
-from lxml import html
+import cookielib
+import threading
+import collections
+from lxml import html, etree
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
-from .. import g, datatools as dt
+from .. import g, datatools as dt, filetools as ft, net, scoring, catalog
+from .. import normalize as nz, release as rl
+from ..entities import Movie, Subtitle
 from . import Provider
 from ..utils import notify, print_debug
 
 log = logging.getLogger(__name__)
 
 
+_dates = {}
+
+def parse_date(text):
+    """ Parse a date in the '%d/%m/%Y - %H:%M' format used by the website.
+        Fast path with slicing instead of datetime.strptime(), and memoized,
+        as the same dates show up over and over again in listings
+    """
+    try:
+        return _dates[text]
+    except KeyError:
+        pass
+
+    try:
+        if (len(text) != 18 or
+            text[2] != '/' or text[5] != '/' or text[10:13] != ' - '):
+            raise ValueError
+        date = datetime(int(text[6:10]), int(text[3:5]), int(text[0:2]),
+                        int(text[13:15]), int(text[16:18]))
+    except (ValueError, IndexError):
+        date = datetime.strptime(text, '%d/%m/%Y - %H:%M')
+
+    if len(_dates) >= 4096:
+        _dates.clear()
+    _dates[text] = date
+    return date
+
+
+class IncompleteListing(g.LegendasError):
+    """ A subtitle listing failed after some of its pages were retrieved.
+        subtitles are the ones found until then, see getSubtitles()
+    """
+    def __init__(self, message, subtitles=None):
+        super(IncompleteListing, self).__init__(message)
+        self.subtitles = subtitles or []
+
+
+class InvalidDownload(IOError):
+    """ A downloaded file failed its integrity check, such as a web page
+        instead of an archive. code, url and content_type are those of the
+        response, head the start of its content
+    """
+    def __init__(self, message, code=None, url=None, content_type=None,
+                 head=b""):
+        super(InvalidDownload, self).__init__(message)
+        self.code = code
+        self.url = url
+        self.content_type = content_type
+        self.head = head
+
+
 # Search Type:
 # <blank> - All subtitles
 # d       - Destaque (Highlighted subtitles only)
@@ -49,48 +106,267 @@ class HttpBot(object):
     """ Base class for other handling basic http tasks like requesting a page,
         download a file and cache content. Not to be used directly
     """
-    def __init__(self, base_url=""):
-        self._opener = urllib2.build_opener(urllib2.HTTPCookieProcessor())
+    # Response cache time-to-live for each URL path regex, in seconds
+    cache_ttls = ()
+
+    # Downloads are not compressed, so their length and ranges are exact
+    download_headers = {'Accept-Encoding': 'identity'}
+
+    def __init__(self, base_url="", pool=None):
+        self.cookiejar = cookielib.LWPCookieJar()
+        self.response_cache = net.ResponseCache(
+            os.path.join(g.globals['cache_dir'], 'http'), self.cache_ttls)
+        self.pool = pool or net.ConnectionPool()
+        self.limiter = net.RateLimiter(rate=g.options['rate_limit'],
+                                       burst=g.options['rate_limit'],
+                                       concurrency=self.pool.maxsize,
+                                       max_concurrency=self.pool.maxsize)
+        self.retries = g.options['retries']
+        self.timeout = g.options['timeout']
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._file_locks = collections.defaultdict(threading.Lock)
+        self.decompression = net.DecompressionProcessor()
+        self.assets = net.FetchQueue(self.cache)
+        self._opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(self.cookiejar),
+            self.decompression,
+            net.KeepAliveHandler(self.pool),
+            net.KeepAliveHTTPSHandler(self.pool))
         scheme, netloc, path, q, f  = urlparse.urlsplit(base_url, "http")
         if not netloc:
             netloc, _, path = path.partition('/')
         self.base_url = urlparse.urlunsplit((scheme, netloc, path, q, f))
+        self.breaker = net.get_breaker(netloc)
 
-    def get(self, url, postdata=None):
+    def get(self, url, postdata=None, headers=None):
         """ Send an HTTP request, either GET (if no postdata) or POST
-            Keeps session and other cookies.
+            Keeps session and other cookies, and reuses connections from
+            self.pool whenever possible. gzip or deflate encoded responses
+            are decoded on the fly. Read the response to its end (or
+            close it) so its connection can be reused.
             postdata is a dict with name/value pairs
+            headers is a dict of extra request headers
             url can be absolute or relative to base_url
+            Plain GET requests for URLs matching cache_ttls are served by
+            self.response_cache if caching is enabled
         """
         url = urlparse.urljoin(self.base_url, url)
-        if postdata:
-            return self._opener.open(url, urllib.urlencode(postdata))
-        else:
-            return self._opener.open(url)
 
-    def download(self, url, savedir, filename="", overwrite=True):
-        download = self.get(url)
+        if (g.options['cache'] and not (postdata or headers)
+            and self.response_cache.ttl(url) is not None):
+            return self._cached_get(url)
+
+        if postdata:
+            postdata = urllib.urlencode(postdata)
+        return self._open(urllib2.Request(url, postdata, headers or {}))
+
+    def _open(self, request):
+        """ Open a request, obeying self.limiter and retrying up to
+            self.retries times on transient errors, such as server overload
+            or connection reset.
+            Each attempt times out after self.timeout seconds, or earlier if
+            the current net.deadline() is closer. Transient errors count as
+            failures for self.breaker, which fails fast when it is open, and
+            any other HTTP response, even an error one, as a success
+        """
+        host = request.get_host()
+        attempt = 0
+        while True:
+            timeout = net.timeout(self.timeout)
+            trial = self.breaker.before()
+            throttled = False
+            try:
+                self.limiter.acquire(host)
+                try:
+                    response = self._opener.open(request, timeout=timeout)
+                    self.breaker.success()
+                    return response
+                except Exception as e:
+                    throttled = net.is_transient(e)
+                    if throttled:
+                        self.breaker.failure()
+                    elif isinstance(e, urllib2.HTTPError):
+                        self.breaker.success()
+                    if not throttled or attempt >= self.retries:
+                        raise
+                    if isinstance(e, urllib2.HTTPError):
+                        e.close()
+                finally:
+                    self.limiter.release(host, throttled)
+            finally:
+                # A trial with no answer must not keep the circuit half open
+                if trial:
+                    self.breaker.release()
+
+            delay = net.backoff(attempt)
+            left = net.remaining()
+            if left is not None and delay >= left:
+                raise e
+            attempt += 1
+            self.limiter.stats['retries'] += 1
+            log.warn("Error requesting %s: %s. Retry %d in %.1f seconds",
+                     request.get_full_url(), e, attempt, delay)
+            time.sleep(delay)
+
+    def _cached_get(self, url):
+        cache = self.response_cache
+        entry, fresh = cache.lookup(url)
+        if fresh:
+            log.debug("Using cached %s", url)
+            return cache.response(entry)
+
+        headers = cache.validators(entry) if entry else {}
+        try:
+            response = self._open(urllib2.Request(url, None, headers))
+        except urllib2.HTTPError as e:
+            if not (e.code == 304 and entry):  # Not Modified
+                raise
+            e.close()
+            log.debug("Revalidated cached %s", url)
+            return cache.response(cache.revalidated(url, entry))
+
+        body = response.read()
+        response.close()
+        return cache.response(cache.store(url, response, body))
+
+    def download(self, url, savedir, filename="", overwrite=True,
+                 validate=None, chunksize=64*1024):
+        """ Download an URL to savedir/filename, using the downloaded file name
+            if filename is not set. Content is streamed in chunks to a
+            temporary '.part' file, only renamed to its final name after its
+            length, and validate(path) if provided, is checked.
+            A '.part' file left by an interrupted download is resumed using
+            an HTTP Range request, sent right away if filename is set.
+            If not overwrite, an existing (and valid) file is used instead.
+            Return the filename (with full path) of the downloaded file
+        """
+        # Handle dir
+        savedir = os.path.expanduser(savedir)
+        ft.safemakedirs(savedir)
 
         # If save name is not set, use the downloaded file name
+        download = None
         if not filename:
+            download = self.get(url, headers=self.download_headers)
             filename = download.geturl().rstrip("/")
 
-        # Handle dir
-        savedir = os.path.expanduser(savedir)
-        if not os.path.isdir(savedir):
-            os.makedirs(savedir)
-
         # Combine dir to convert filename to a full path
         filename = os.path.join(savedir, os.path.basename(filename))
 
-        if overwrite or not os.path.isfile(filename):
-            with open(filename,'wb') as f:
-                f.write(download.read())
-        else:
-            log.debug("Using cached file")
+        # Concurrent downloads of the same file must not share its '.part'
+        with self._file_lock(filename):
+            return self._save(url, download, filename, overwrite,
+                              validate, chunksize)
 
+    def _file_lock(self, filename):
+        with self._lock:
+            return self._file_locks[filename]
+
+    def _save(self, url, download, filename, overwrite, validate, chunksize):
+        """ Save url to filename, using download, its response, if already
+            requested, see download()
+        """
+        if not overwrite and os.path.isfile(filename):
+            if validate is None or validate(filename):
+                if download is not None:
+                    download.close()
+                log.debug("Using cached file")
+                return filename
+            log.warn("Cached file '%s' is invalid, downloading again", filename)
+
+        partfile = filename + ".part"
+        offset = 0
+        if os.path.isfile(partfile):
+            offset = os.path.getsize(partfile)
+        if offset:
+            download, offset = self._resume(url, download, offset)
+        elif download is None:
+            download = self.get(url, headers=self.download_headers)
+
+        size = offset
+        with open(partfile, 'ab' if offset else 'wb') as f:
+            while True:
+                net.check_deadline()
+                chunk = download.read(chunksize)
+                if not chunk:
+                    break
+                f.write(chunk)
+                size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        download.close()
+
+        # A short file is kept, so next attempt can resume it
+        expected = self._content_total(download, offset)
+        if expected is not None and size != expected:
+            if size > expected:
+                os.remove(partfile)
+            raise IOError("Incomplete download of %s: %d of %d bytes" %
+                          (url, size, expected))
+
+        if validate is not None and not validate(partfile):
+            with open(partfile, 'rb') as f:
+                head = f.read(4096)
+            os.remove(partfile)
+            raise InvalidDownload("Downloaded file '%s' failed integrity"
+                                  " check" % filename,
+                                  download.getcode(), download.geturl(),
+                                  download.info().gettype(), head)
+
+        os.rename(partfile, filename)
         return filename
 
+    def _resume(self, url, download, offset):
+        """ Request url from offset, replacing download, its full response
+            if already requested, so it must be requested again.
+            Return a 2-tuple (response, offset), offset being 0 if the server
+            won't resume and the download must start over
+        """
+        if download is not None:
+            url = download.geturl()
+            download.close()
+        try:
+            headers = dict(self.download_headers, Range='bytes=%d-' % offset)
+            response = self.get(url, headers=headers)
+        except urllib2.HTTPError as e:
+            if e.code != 416:  # Requested Range Not Satisfiable
+                raise
+            e.close()
+            log.debug("Could not resume %s, restarting", url)
+            return self.get(url, headers=self.download_headers), 0
+
+        if (response.getcode() == 206 and
+            self._content_range(response)[0] == offset):
+            log.debug("Resuming %s from byte %d", url, offset)
+            return response, offset
+
+        if response.getcode() != 200:
+            response.close()
+            response = self.get(url, headers=self.download_headers)
+        return response, 0
+
+    def _content_range(self, response):
+        """ Parse 'Content-Range: bytes start-end/total' of a response.
+            Return a 2-tuple (start, total), each None if not available
+        """
+        match = re.match(r"bytes\s+(\d+)-\d+/(\d+|\*)",
+                         response.info().getheader('Content-Range', ""))
+        if not match:
+            return None, None
+        start, total = match.groups()
+        return int(start), int(total) if total.isdigit() else None
+
+    def _content_total(self, response, offset=0):
+        """ Expected full size of a (possibly partial) download, if known """
+        if response.getcode() == 206:
+            total = self._content_range(response)[1]
+            if total is not None:
+                return total
+        length = response.info().getheader('Content-Length')
+        if length and length.isdigit():
+            return offset + int(length)
+
     def cache(self, url, subdir=""):
         filename = os.path.join(g.globals['cache_dir'], subdir, os.path.basename(url))
         if os.path.exists(filename):
@@ -98,6 +374,32 @@ class HttpBot(object):
         else:
             return (self.download(url, os.path.join(g.globals['cache_dir'], subdir)))
 
+    def prefetch(self, url, subdir=""):
+        """ Cache an URL in background, using self.assets. Repeated calls
+            for the same URL are merged. Return an AsyncResult for cache()
+        """
+        return self.assets.submit((url, subdir), url, subdir)
+
+    def load_cookies(self, filename):
+        """ Load cookies saved by save_cookies(), including session ones.
+            Return False if file is missing or invalid
+        """
+        try:
+            self.cookiejar.load(filename, ignore_discard=True)
+        except IOError as e:
+            log.debug("Could not load cookies: %s", e)
+            return False
+        return True
+
+    def save_cookies(self, filename):
+        """ Save all cookies, including session ones, to a file readable by
+            its owner only, as they work as credentials
+        """
+        ft.safemakedirs(os.path.dirname(filename))
+        os.close(os.open(filename, os.O_WRONLY | os.O_CREAT, 0o600))
+        os.chmod(filename, 0o600)
+        self.cookiejar.save(filename, ignore_discard=True)
+
     def quote(self, text):
         """ Quote a text for URL usage, similar to urllib.quote_plus.
             Handles unicode and also encodes "/"
@@ -110,8 +412,17 @@ class HttpBot(object):
         """ Parse an URL and return an etree ElementRoot.
             Assumes UTF-8 encoding
         """
-        return html.parse(self.get(url, postdata),
-                          parser=html.HTMLParser(encoding='utf-8'))
+        return html.parse(self.get(url, postdata), parser=self._parser())
+
+    def _parser(self):
+        """ HTML parser, reused across calls. lxml parsers are not
+            thread-safe, so there's one for each thread
+        """
+        try:
+            return self._local.parser
+        except AttributeError:
+            self._local.parser = html.HTMLParser(encoding='utf-8')
+            return self._local.parser
 
 class LegendasTV(HttpBot, Provider):
 
@@ -120,24 +431,49 @@ class LegendasTV(HttpBot, Provider):
 
     _re_sub_language = re.compile(r"idioma/\w+_(\w+)\.")
 
-    def __init__(self):
-        super(LegendasTV, self).__init__(self.url)
-        self.auth = False
+    cache_ttls = (
+        (r"/legenda/sugestao/",           24*60*60),
+        (r"/util/carrega_legendas_busca",    60*60),
+    )
 
-    def login(self, login, password):
+    def __init__(self, pool=None):
+        super(LegendasTV, self).__init__(self.url, pool)
+        self.auth = False
+        self._credentials = None
+        self._login_lock = threading.Lock()
+        self.catalog = catalog.Catalog(
+            os.path.join(g.globals['cache_dir'], "catalog.sqlite"),
+            g.options['titles_ttl'], g.options['listings_ttl'])
+
+    def login(self, login, password, fresh=False):
+        """ Log in, or reuse the session saved by a previous login of the
+            same user if caching is enabled, unless fresh. A saved session
+            is assumed valid until a download is rejected, see
+            downloadSubtitle().
+            Return whether user is (assumed to be) logged in
+        """
         if not (login and password):
             return
 
+        self._credentials = (login, password)
+        session = os.path.join(g.globals['cache_dir'],
+                               "session_%s.txt" % self.quote(login))
+        if (g.options['cache'] and not fresh and
+            self.load_cookies(session) and len(self.cookiejar)):
+            log.info("Reusing saved session for %s", login)
+            self.auth = True
+            return self.auth
+
         url = "/login"
         log.info("Logging in %s as %s", self.base_url + url, login)
 
         try:
             response = self.get(url, {'data[User][username]': login,
                                       'data[User][password]': password})
-        except (urllib2.HTTPError, urllib2.URLError) as e:
+        except (urllib2.URLError, urllib2.httplib.HTTPException) as e:
             if (getattr(e, 'code', 0) in (513,  # Service Unavailable
                                           )
-                or any(str(errno) in e.reason
+                or any(str(errno) in getattr(e, 'reason', "")
                        for errno in (111,       # Connection refused
                                      ))) or True:
                 log.error(e)
@@ -146,10 +482,27 @@ class LegendasTV(HttpBot, Provider):
                 raise
 
         # Check login: url redirect and logout link available
+        # Always read the page, so the connection goes back to the pool
+        content = response.read()
         self.auth = (not response.geturl().endswith(url)
-                     and b'href="/users/logout"' in response.read())
+                     and b'href="/users/logout"' in content)
+        if self.auth and g.options['cache']:
+            self.save_cookies(session)
         return self.auth
 
+    def _renew_session(self):
+        """ Log in again, in case the current session was rejected.
+            Return whether it succeeded
+        """
+        if not self._credentials:
+            return False
+        with self._login_lock:
+            try:
+                return bool(self.login(*self._credentials, fresh=True))
+            except g.LegendasError as e:
+                log.error(e)
+                return False
+
     languages = dict(
         pb = dict(id= 1, code="brazil",  name="Português-BR"),
         en = dict(id= 2, code="usa",     name="Inglês"),
@@ -217,11 +570,21 @@ class LegendasTV(HttpBot, Provider):
 
 
     def getMovies(self, text):
-        """ Given a search text, return a list of dicts with basic movie info:
-            id, title, title_br, thumb (relative url for a thumbnail image)
+        """ Given a search text, return a list of Movie records (usable as
+            dicts) with basic movie info: id, title, title_br, thumb (url for a
+            thumbnail image), year, type, season and imdb_id
+            Searches are saved in self.catalog if caching is enabled, and
+            a stale one is used if the website fails
         """
         movies = []
 
+        cached = None
+        if g.options['cache']:
+            cached, fresh = self.catalog.lookup_movies(text)
+            if fresh:
+                log.debug("Using catalog titles for '%s'", text)
+                return cached
+
         searchtext = text
         #searchtext = searchtext.replace("'", "\\'")
         searchtext = searchtext.replace(":", " ")
@@ -229,10 +592,17 @@ class LegendasTV(HttpBot, Provider):
         log.debug("loading %s", url)
         try:
             tree = json.load(self.get(url))
-        except (urllib2.HTTPError, urllib2.httplib.BadStatusLine) as e:
+        except (urllib2.URLError, urllib2.httplib.HTTPException,
+                net.CircuitOpenError) as e:
+            if cached is not None:
+                log.warn("Using stale catalog titles for '%s': %s", text, e)
+                return cached
+            if not isinstance(e, (urllib2.HTTPError,
+                                  urllib2.httplib.BadStatusLine)):
+                raise
             notify("Server error retrieving URL!")
             log.error(e)
-            tree = []
+            return movies
 
         # [{"_index":"filmes","_type":"filme","_id":"772","_score":null,
         #   "_source":{"id_filme":"772",
@@ -284,6 +654,8 @@ class LegendasTV(HttpBot, Provider):
         #              "deleted":False},
         #   "sort":["3"]},]
 
+        assets = self._fetch_assets()
+
         mapping = dict(
             id       = "id_filme",
             title    = "dsc_nome",
@@ -302,45 +674,66 @@ class LegendasTV(HttpBot, Provider):
 
         for e in tree:
             item = e['_source']
-            movie = {k: item.get(v, None) for k, v in mapping.iteritems()}
+            movie = Movie((k, item.get(v, None)) for k, v in mapping.iteritems())
 
-            if movie.get('thumb', None):
-                movie['thumb'] = "http://i.legendas.tv/poster/" + movie['thumb']
-                if g.options['cache']:
-                    self.cache(movie['thumb'], 'thumbs')
+            if movie.thumb:
+                movie.thumb = "http://i.legendas.tv/poster/" + movie.thumb
+                if assets:
+                    self.prefetch(movie.thumb, 'thumbs')
 
-            if movie.get('type', None):
-                movie['type'] = typemap.get(movie['type'], None)
+            if movie.type:
+                movie.type = typemap.get(movie.type, None)
 
             movies.append(movie)
 
+        if g.options['cache']:
+            self.catalog.store_movies(text, movies)
+
         print_debug("Titles found for '%s':\n%s" % (text,
                                                     dt.print_dictlist(movies)))
         return movies
 
 
-    """ Convenience wrappers for the main getSubtitles method """
-
-    def getSubtitlesByMovie(self, movie, stype=None, lang=None, allpages=True):
-        return self.getSubtitles(movie_id=movie['id'],
-                                 stype=stype,
-                                 lang=lang,
-                                 allpages=allpages)
-
-    def getSubtitlesByMovieId(self, movie_id, stype=None, lang=None, allpages=True):
-        return self.getSubtitles(movie_id=movie_id,
-                                 stype=stype,
-                                 lang=lang,
-                                 allpages=allpages)
+    """ Convenience wrappers for the main getSubtitles method.
+        If lazy, return an iterSubtitles generator instead of a list.
+        Other keyword arguments, like until and maxpages, are passed along
+    """
 
-    def getSubtitlesByText(self, text, stype=None, lang=None, allpages=True):
-        return self.getSubtitles(text=text,
-                                 stype=stype,
-                                 lang=lang,
-                                 allpages=allpages)
+    def getSubtitlesByMovie(self, movie, stype=None, lang=None, allpages=True,
+                            lazy=False, **kwargs):
+        return self._getSubtitles(lazy,
+                                  movie_id=movie['id'],
+                                  stype=stype,
+                                  lang=lang,
+                                  allpages=allpages,
+                                  **kwargs)
+
+    def getSubtitlesByMovieId(self, movie_id, stype=None, lang=None, allpages=True,
+                              lazy=False, **kwargs):
+        return self._getSubtitles(lazy,
+                                  movie_id=movie_id,
+                                  stype=stype,
+                                  lang=lang,
+                                  allpages=allpages,
+                                  **kwargs)
+
+    def getSubtitlesByText(self, text, stype=None, lang=None, allpages=True,
+                           lazy=False, **kwargs):
+        return self._getSubtitles(lazy,
+                                  text=text,
+                                  stype=stype,
+                                  lang=lang,
+                                  allpages=allpages,
+                                  **kwargs)
+
+    def _getSubtitles(self, lazy, **kwargs):
+        if lazy:
+            return self.iterSubtitles(**kwargs)
+        else:
+            return self.getSubtitles(**kwargs)
 
     def getSubtitles(self, text="", stype=None, lang=None, movie_id=None,
-                       allpages=True):
+                       allpages=True, window=None, until=None, maxpages=None):
         """ Main method for searching, parsing and retrieving subtitles info.
             Arguments:
             text  - The text to search for
@@ -351,22 +744,75 @@ class LegendasTV(HttpBot, Provider):
                       in constants
             movie_id - search all subtitles from the specified movie. If used,
                        text and type (but not lang) are ignored
+            allpages - follow all result pages, not only the first one
+            window - number of result pages fetched ahead in background.
+                     Default from options, 0 to fetch one page at a time.
+                     Once until is satisfied, reading ahead stops, so at
+                     most window pages are fetched for nothing
+            until - a function called for each subtitle found. Once it returns
+                    True, no more pages are searched after the current one.
+                    See scoreAtLeast(). One with state must have a copy()
+                    method, see _catalog_pages()
+            maxpages - maximum number of pages to search. Default from
+                       options, 0 for no limit
             Either text or movie_id must be provided
-            Return a list of dictionaries with the subtitles found. Some info
-            is related to the movie, not to that particular subtitle
+            Return a list of Subtitle records (usable as dictionaries) with the
+            subtitles found. Some info is related to the movie, not to that
+            particular subtitle
+            If the website fails after the first page, IncompleteListing is
+            raised with the subtitles found until then
+        """
+        subtitles = []
+        try:
+            for sub in self.iterSubtitles(text, stype, lang, movie_id,
+                                          allpages, window, until, maxpages):
+                subtitles.append(sub)
+        except IncompleteListing as e:
+            e.subtitles = subtitles
+            raise
+
+        print_debug("Subtitles found for %s:\n%s" %
+                   ( movie_id or "'%s'" % text, dt.print_dictlist(subtitles)))
+        return subtitles
+
+    def iterSubtitles(self, text="", stype=None, lang=None, movie_id=None,
+                        allpages=True, window=None, until=None, maxpages=None):
+        """ Generator version of getSubtitles(), same arguments.
+            Yield each Subtitle record as soon as its page is parsed,
+            so only a single page is held in memory.
+            Listings of a movie_id are saved in self.catalog if caching is
+            enabled. A fresh one is used if it has the pages a search of
+            the website would get, see _catalog_pages(). A stale one is used
+            if the website fails on the first page. A failure on a later page
+            raises IncompleteListing, after the subtitles of previous pages
         """
         if lang is None:
             lang = g.options['language'] or ""
 
+        if maxpages is None:
+            maxpages = g.options['max_pages']
+
+        cached = None
+        if movie_id and g.options['cache']:
+            cached, fresh, complete = self.catalog.lookup_subtitles(
+                movie_id, lang, stype)
+            pages = None
+            if fresh:
+                pages = self._catalog_pages(cached, complete, allpages, until,
+                                            maxpages)
+            if pages is not None:
+                log.debug("Using %d pages of catalog subtitles for %s",
+                          pages, movie_id)
+                for page in cached[:pages]:
+                    for sub in page:
+                        yield sub
+                return
+
         # Convert 2-char language ISO code to lang_id used in search
         lang_id = self.languages.get(lang, {}).get('id', 0)
 
-        # "re-map" languages to a format useful for fast subtitle processing
-        languages = {}
-        for lang_iso, language in self.languages.iteritems():
-            languages[language['code']] = lang_iso
-
-        subtitles = []
+        languages = self._language_codes()
+        assets = self._fetch_assets()
 
         url = "/util/carrega_legendas_busca"
         if movie_id:  url += "_filme/"     + str(movie_id)
@@ -380,73 +826,204 @@ class LegendasTV(HttpBot, Provider):
         if stype:
             url += "/" + stype
 
+        subs = [] if movie_id and g.options['cache'] else None
+        tree = None
+        pages = self._iter_pages(url, allpages, window, maxpages)
+        try:
+            for page, tree in enumerate(pages, 1):
+                found = False
+                if subs is not None:
+                    subs.append([])
+                for sub in self._parse_listing(tree, languages):
+                    if assets: self.prefetch(sub.flag)
+                    if until is not None and not found:
+                        found = until(sub)
+                    if subs is not None:
+                        subs[-1].append(sub)
+                    yield sub
+
+                if found:
+                    log.debug("Good subtitle found in page %d, stop searching", page)
+                    break
+        except (urllib2.URLError, urllib2.httplib.HTTPException,
+                net.CircuitOpenError) as e:
+            if tree is not None:
+                notify("Server error retrieving URL!")
+                raise IncompleteListing("Subtitle listing cut short after"
+                                        " page %d: %s" % (page, e))
+            if cached is None:
+                raise
+        finally:
+            # Stop reading ahead once done, or if the caller stops early
+            pages.close()
+
+        if tree is None:
+            # Not even the first page, see _iter_pages()
+            if cached is not None:
+                log.warn("Using stale catalog subtitles for %s", movie_id)
+                pages = 1 if not allpages else maxpages or len(cached)
+                for page in cached[:pages]:
+                    for sub in page:
+                        yield sub
+        elif subs is not None:
+            # Complete if there was no page left
+            self.catalog.store_subtitles(
+                movie_id, lang, stype, subs,
+                complete=allpages and not self._xp_next(tree))
+
+
+    def _catalog_pages(self, pages, complete, allpages, until, maxpages):
+        """ Number of pages of a catalog listing, as returned by
+            Catalog.lookup_subtitles(), a search of the website with the same
+            arguments would get, or None if it may get more pages.
+            until is tested on a copy() of it, if it has this method, as a
+            predicate with state, like subtitles.good_subtitles(), must be
+            left as it was for the website search
+        """
+        if pages is None:
+            return None
+
+        limit = len(pages) if complete else None
+        if not allpages:
+            limit = 1
+        elif maxpages:
+            limit = maxpages
+
+        if until is not None:
+            test = until.copy() if hasattr(until, 'copy') else until
+            for number, page in enumerate(pages[:limit], 1):
+                if any(test(sub) for sub in page):
+                    return number
+
+        if limit is not None and (complete or len(pages) >= limit):
+            return min(limit, len(pages))
+
+    def _fetch_assets(self):
+        """ Whether thumbnails and flags should be cached. They are only
+            used as notification icons, so not when notifications are off
+        """
+        return g.options['cache'] and g.options['notifications']
+
+    def getThumbnail(self, movie):
+        """ Return the local file of a movie thumbnail if already cached, or
+            the application icon, queueing its download for later calls.
+            Never waits for the download, so it adds nothing to searches
+        """
+        if not movie.get('thumb'):
+            return ""
+        thumbnail = os.path.join(g.globals['cache_dir'], 'thumbs',
+                                 os.path.basename(movie['thumb']))
+        if os.path.isfile(thumbnail):
+            return thumbnail
+        if self._fetch_assets():
+            self.prefetch(movie['thumb'], 'thumbs')
+        return g.globals['appicon']
+
+    def _language_codes(self):
+        """ "re-map" languages to a format useful for fast subtitle processing:
+            a dict of flag code -> ISO code
+        """
+        languages = {}
+        for lang_iso, language in self.languages.iteritems():
+            languages[language['code']] = lang_iso
+        return languages
+
+    # Precompiled XPath for subtitle listing pages
+    _xp_rows = etree.XPath(".//article/div")
+    _xp_text = etree.XPath(".//text()", smart_strings=False)
+    _xp_link = etree.XPath("(.//a)[1]/@href", smart_strings=False)
+    _xp_flag = etree.XPath("./img[1]/@src", smart_strings=False)
+    _xp_next = etree.XPath("//a[@class='load_more'][1]/@href",
+                           smart_strings=False)
+
+    def _parse_listing(self, tree, languages=None):
+        """ Parse a subtitle listing page, yielding a Subtitle for each one.
+            languages is the _language_codes() mapping
+        """
+        if languages is None:
+            languages = self._language_codes()
+
+        # Language for each flag image, there are just a few
+        flags = {}
+
+        # <div class="">
+        #     <span class="number number_2">35</span>
+        #     <div class="f_left">
+        #         <p><a href="/download/c0c4d6418a3474b2fb4e9dae3f797bd4/Gattaca/gattaca_dvdrip_divx61_ac3_sailfish">gattaca_dvdrip_divx61_ac3_(sailfish)</a></p>
+        #         <p class="data">1210 downloads, nota 10, enviado por <a href="/usuario/SuperEly">SuperEly</a> em 02/11/2006 - 16:13 </p>
+        #     </div>
+        #     <img src="/img/idioma/icon_brazil.png" alt="Portugu&#234;s-BR" title="Portugu&#234;s-BR">
+        # </div>
+        for e in self._xp_rows(tree):
+            cls = e.get('class', "")
+            if cls.startswith('banner'): continue
+            data = self._xp_text(e)
+            dataurl = self._xp_link(e)[0].split('/')
+            dataline = data[2].split(' ')
+            sub = Subtitle(
+                hash        = dataurl[2],
+                title       = dataurl[3],
+                downloads   = dataline[0],
+                rating      = dataline[3][:-1] or None,
+                date        = parse_date(data[4].strip()[3:]),
+                user_name   = data[3],
+                release     = data[1],
+                pack        = cls == 'pack',
+                highlight   = cls == 'destaque',
+                flag        = self._xp_flag(e)[0],
+            )
+            dt.fields_to_int(sub, 'downloads', 'rating')
+
+            if sub.flag not in flags:
+                flags[sub.flag] = languages.get(
+                    re.search(self._re_sub_language, sub.flag).group(1))
+            sub.language = flags[sub.flag]
+
+            if sub.release.startswith("(p)") and sub.pack:
+                sub.release = sub.release[3:]
+
+            yield sub
+
+    def _iter_pages(self, url, allpages=True, window=None, maxpages=0):
+        """ Yield parsed result pages, in order, starting at url and following
+            their 'load_more' links if allpages, up to maxpages pages if set.
+            Up to window pages are read ahead in background while current one
+            is being processed, see net.read_ahead(). A page is only requested
+            once the previous one links to it, so reading ahead never goes
+            past the last page
+        """
+        if window is None:
+            window = g.options['prefetch_pages']
+
+        pages = self._read_pages(url, allpages, maxpages)
+        if allpages and window > 0:
+            pages = net.read_ahead(pages, window)
+        return pages
+
+    def _read_pages(self, url, allpages, maxpages):
         page = 0
-        lastpage = False
-        while not lastpage:
+        while url:
             page += 1
             log.debug("loading %s", url)
-            try:
-                tree = self.parse(url)
-            except (urllib2.HTTPError, urllib2.httplib.BadStatusLine) as e:
-                notify("Server error retrieving URL!")
-                log.error(e)
-                break
-
-            # <div class="">
-            #     <span class="number number_2">35</span>
-            #     <div class="f_left">
-            #         <p><a href="/download/c0c4d6418a3474b2fb4e9dae3f797bd4/Gattaca/gattaca_dvdrip_divx61_ac3_sailfish">gattaca_dvdrip_divx61_ac3_(sailfish)</a></p>
-            #         <p class="data">1210 downloads, nota 10, enviado por <a href="/usuario/SuperEly">SuperEly</a> em 02/11/2006 - 16:13 </p>
-            #     </div>
-            #     <img src="/img/idioma/icon_brazil.png" alt="Portugu&#234;s-BR" title="Portugu&#234;s-BR">
-            # </div>
-            for e in tree.xpath(".//article/div"):
-                if e.attrib['class'].startswith('banner'): continue
-                data = e.xpath(".//text()")
-                dataurl = e.xpath(".//a")[0].attrib['href'].split('/')
-                dataline = data[2].split(' ')
-                sub = dict(
-                    hash        = dataurl[2],
-                    title       = dataurl[3],
-                    downloads   = dataline[0],
-                    rating      = dataline[3][:-1] or None,
-                    date        = data[4].strip()[3:],
-                    user_name   = data[3],
-                    release     = data[1],
-                    pack        = e.attrib['class'] == 'pack',
-                    highlight   = e.attrib['class'] == 'destaque',
-                    flag        = e.xpath("./img")[0].attrib['src']
-                )
-                dt.fields_to_int(sub, 'downloads', 'rating')
-                sub['language'] = languages.get(re.search(self._re_sub_language,
-                                                          sub['flag']).group(1))
-                sub['date'] = datetime.strptime(sub['date'], '%d/%m/%Y - %H:%M')
-                if sub['release'].startswith("(p)") and sub['pack']:
-                    sub['release'] = sub['release'][3:]
-
-                if g.options['cache']: self.cache(sub['flag'])
-                subtitles.append(sub)
+            tree = self.parse(url)
 
             # Page control
-            if not allpages:
-                lastpage = True
-            else:
-                nextpage = tree.xpath("//a[@class='load_more']")
+            url = None
+            if allpages and not (maxpages and page >= maxpages):
+                nextpage = self._xp_next(tree)
                 if nextpage:
-                    url = nextpage[0].attrib['href']
-                else:
-                    lastpage = True
-
-        print_debug("Subtitles found for %s:\n%s" %
-                   ( movie_id or "'%s'" % text, dt.print_dictlist(subtitles)))
-        return subtitles
+                    url = nextpage[0]
 
+            yield tree
 
     def downloadSubtitle(self, filehash, savedir, basename="", overwrite=True):
         """ Download a subtitle archive based on subtitle id.
             Saves the archive as dir/basename, using the basename provided or,
             if empty, the one returned from the website.
-            Return the filename (with full path) of the downloaded archive
+            A session rejected by the website, which then sends its login
+            page instead of the archive, is renewed once and retried.
+            Return the filename (with full path) of the downloaded archive,
+            or None if download failed
         """
         if not self.auth:
             log.warn("Subtitle download requires user to be logged in")
@@ -454,50 +1031,170 @@ class LegendasTV(HttpBot, Provider):
         url = '/downloadarquivo/%s' % filehash
         print_debug("Downloading archive for subtitle from %s" % url)
 
-        try:
-            result = self.download(url, savedir, basename, overwrite=overwrite)
-        except (urllib2.HTTPError, urllib2.httplib.BadStatusLine) as e:
-            log.error(e)
-            return
+        renew = True
+        while True:
+            try:
+                result = self.download(url, savedir, basename,
+                                       overwrite=overwrite,
+                                       validate=ft.is_archive)
+                break
+            except InvalidDownload as e:
+                if not (renew and self._login_page(e) and
+                        self._renew_session()):
+                    log.error(e)
+                    return
+                log.info("Download rejected, retrying with a new session")
+                renew = False
+            except (IOError, urllib2.httplib.BadStatusLine) as e:
+                log.error(e)
+                return
 
         print_debug("Archive saved as '%s'" % (result))
         return result
 
-    def rankSubtitles(self, movie, subtitles):
+    def _login_page(self, download):
+        """ Whether an InvalidDownload is the login page, sent instead of
+            the archive when the session expired, and not a broken archive
+        """
+        return (download.content_type == 'text/html' or
+                urlparse.urlsplit(download.url or "").path == "/login" or
+                b"data[User][password]" in download.head)
+
+    def rankSubtitles(self, movie, subtitles, top=None):
         """ Evaluates each subtitle based on wanted movie and give each a score.
-            Return the list sorted by score, greatest first
+            Return the list sorted by score, greatest first.
+            If top is set, return only the top best subtitles. In this mode
+            subtitles can be any iterable, like iterSubtitles(), consumed in
+            a single pass that keeps only the best candidates in a heap.
+            Lists are scored in batch by _score_subtitles()
         """
+        first = last = None
+        if top and not isinstance(subtitles, (list, tuple)):
+            subtitles, first, last = self._top_subtitles(
+                subtitles, top, self._subtitle_scorer(movie))
+        else:
+            subtitles = list(subtitles)
 
         if not subtitles:
             return
 
-        def days(d):
-            return (datetime.today() - d).days
+        scores = self._score_subtitles(movie, subtitles, first, last)
+        for sub, score in zip(subtitles, scores):
+            sub.score = score
 
-        oldest = days(min([s['date'] for s in subtitles]))
-        newest = days(max([s['date'] for s in subtitles]))
+        result = [subtitles[i] for i in scoring.ranking(scores)[:top]]
+        if log.isEnabledFor(logging.DEBUG):
+            print_debug("Ranked subtitles for %s:\n%s" %
+                        (movie, dt.print_dictlist(result)))
+        return result
+
+
+    def _score_subtitles(self, movie, subtitles, first=None, last=None):
+        """ List of rankSubtitles() scores of subtitles for movie, computed
+            in batch, see scoring module. Age is relative to the first and
+            last dates, by default the oldest and newest in subtitles.
+            Same scores as _subtitle_scorer() plus age, normalized to 10
+        """
+        title = nz.normalize(movie['title'])
+        match_release = self._release_matcher(movie)
+        today = datetime.today()
+
+        days = scoring.ages([sub.date for sub in subtitles], today)
+        oldest = (today - first).days if first else max(days)
+        newest = (today - last).days  if last  else min(days)
+
+        score = scoring.weighted_sum([
+            (10, scoring.similarities(title, [sub.title for sub in subtitles],
+                                      nz.normalize)),
+            ( 5, scoring.distinct(match_release, [sub.release
+                                                  for sub in subtitles])),
+            ( 2, [1 if sub.highlight else 0 for sub in subtitles]),
+            ( 1, [1 if sub.pack else 0 for sub in subtitles]),
+            ( 1, [sub.rating/10 if sub.rating is not None else 0.8
+                  for sub in subtitles]),
+            ( 1, scoring.recency(days, oldest, newest)),
+        ])
+        return scoring.tolist(scoring.rescale(score, 0, 20))
+
+
+    def _subtitle_scorer(self, movie):
+        """ Return a function that scores a subtitle for movie by every
+            rankSubtitles() criteria but age, which is relative to the whole
+            set and worth at most 1 point. Total score is normalized to 10
+            by rankSubtitles() dividing by 2
+        """
+        # Compare normalized forms, memoized, as subtitles share titles
+        similarity = dt.similarity_engine()
+        title = nz.normalize(movie['title'])
+        match_release = self._release_matcher(movie)
 
-        for sub in subtitles:
+        def partial_score(sub):
             score = 0
 
-            score += 10 * dt.get_similarity(dt.clean_string(movie['title']),
-                                            dt.clean_string(sub['title']))
-            score +=  5 * dt.get_similarity(movie['release'],
-                                            dt.clean_string(sub['release']))
-            score +=  2 * 1 if sub['highlight'] else 0
-            score +=  1 * 1 if sub['pack'] else 0
-            score +=  1 * (sub['rating']/10 if sub['rating'] is not None else 0.8)
-            score +=  1 * (1 - ( (days(sub['date'])-newest)/(oldest-newest)
-                                 if oldest != newest
-                                 else 0 ))
-
-            sub['score'] = 10 * score / 20
-
-        result = sorted(subtitles, key=operator.itemgetter('score'),
-                        reverse=True)
-        print_debug("Ranked subtitles for %s:\n%s" % (movie,
-                                                      dt.print_dictlist(result)))
-        return result
+            score += 10 * similarity(title, nz.normalize(sub.title))
+            score +=  5 * match_release(sub.release)
+            score +=  2 * 1 if sub.highlight else 0
+            score +=  1 * 1 if sub.pack else 0
+            score +=  1 * (sub.rating/10 if sub.rating is not None else 0.8)
+            return score
+
+        return partial_score
+
+
+    def _release_matcher(self, movie):
+        """ Return a function giving the similarity of a subtitle release to
+            movie release, comparing their fields, see release module.
+            If movie release has none, only a title, fall back to comparing
+            the whole strings
+        """
+        wanted = rl.parse_release(movie['release'])
+        if rl.comparable(wanted):
+            return lambda text: rl.match_release(wanted, rl.parse_release(text))
+
+        similarity = dt.similarity_engine()
+        release = nz.normalize(movie['release'])
+        return lambda text: similarity(release, nz.normalize(text))
+
+
+    def scoreAtLeast(self, movie, score):
+        """ Return a predicate telling if a subtitle is sure to be ranked by
+            rankSubtitles() with at least score for movie, whatever the other
+            subtitles are. Suitable for getSubtitles(until=...)
+        """
+        partial_score = self._subtitle_scorer(movie)
+        return lambda sub: 10 * partial_score(sub) / 20 >= score
+
+
+    def _top_subtitles(self, subtitles, top, partial_score):
+        """ Single pass selection of rankSubtitles() candidates.
+            Keep a min-heap of the top best subtitles by partial score, plus
+            the ones that may still reach the top thanks to the age score,
+            at most 1 point. Return a 3-tuple with a list of these subtitles
+            in original order, and the oldest and newest dates
+        """
+        heap = []   # (partial score, index, subtitle)
+        extra = []  # near misses
+        first = last = None
+
+        for i, sub in enumerate(subtitles):
+            first = min(first or sub.date, sub.date)
+            last  = max(last  or sub.date, sub.date)
+
+            item = (partial_score(sub), i, sub)
+            if len(heap) < top:
+                heapq.heappush(heap, item)
+                continue
+
+            if item[0] > heap[0][0]:
+                item = heapq.heapreplace(heap, item)
+
+            if item[0] + 1 > heap[0][0]:
+                extra.append(item)
+                if len(extra) > top:
+                    extra = [e for e in extra if e[0] + 1 > heap[0][0]]
+
+        candidates = sorted(heap + extra, key=operator.itemgetter(1))
+        return [sub for _, _, sub in candidates], first, last
 
 
     def _matching_points(self, ref, val, p):
@@ -511,7 +1208,7 @@ class LegendasTV(HttpBot, Provider):
 
     def rankMovies(self, movie, movies):
         year = movie.get('year', None)
-        title = dt.clean_string(movie['title'])
+        title = nz.normalize(movie['title'])
         mtype = 'movie'
         points = dict(
             year  = (0, 1, -1, -3, 5),
@@ -521,26 +1218,28 @@ class LegendasTV(HttpBot, Provider):
         max_score = sum((max(w) for w in points.itervalues()))
         min_score = sum((min(w) for w in points.itervalues()))
 
-        for m in movies:
-            y = m.get('year', None)
-            t = m.get('type', None)
-            s = dt.get_similarity(title, dt.clean_string(m['title']))
-
-            score = 0
-            score += self._matching_points(year,  y, points['year'])
-            score += self._matching_points(mtype, t, points['type'])
-            score += s * points['title'][0]
-
-            m['score'] = 10.0 * (score - min_score) / (max_score - min_score)
-            m['similarity'] = s
-
-        result = sorted(movies,
-                        key=operator.itemgetter('score'),
-                        reverse=True)
-
-        print_debug("Ranked movies for %s:\n%s" %
-                    (movie,
-                     dt.print_dictlist(result)))
+        # Scored in batch, see scoring module
+        similarity = scoring.similarities(title, [m.title for m in movies],
+                                          nz.normalize)
+        score = scoring.weighted_sum([
+            (1, [self._matching_points(year,  m.year, points['year'])
+                 for m in movies]),
+            (1, [self._matching_points(mtype, m.type, points['type'])
+                 for m in movies]),
+            (points['title'][0], similarity),
+        ])
+        scores = scoring.tolist(scoring.rescale(score, min_score, max_score))
+
+        for m, score, s in zip(movies, scores, similarity):
+            m.score = score
+            m.similarity = s
+
+        result = [movies[i] for i in scoring.ranking(scores)]
+
+        if log.isEnabledFor(logging.DEBUG):
+            print_debug("Ranked movies for %s:\n%s" %
+                        (movie,
+                         dt.print_dictlist(result)))
 
         return result
 
@@ -554,3 +1253,47 @@ class LegendasTV(HttpBot, Provider):
         else:
             ranker = self.rankMovies
         return ranker(title, titles)
+
+
+class AsyncLegendasTV(object):
+    """ Asynchronous front-end to LegendasTV, for batch processing.
+        Calling any LegendasTV method, such as login(), getMovies(),
+        getSubtitles() or downloadSubtitle(), returns immediately an
+        AsyncResult, whose get() waits for and returns the method result,
+        or raises its exception. An optional callback keyword argument is
+        called with the result as soon as it is available. Other
+        attributes, such as auth or languages, are the provider ones.
+        All calls share a single provider session, cookies and connection
+        pool, with up to workers requests in flight, the others queued.
+        Example, searching several titles at once:
+
+            with AsyncLegendasTV() as ltv:
+                ltv.login(username, password).get()
+                searches = [ltv.getMovies(title) for title in titles]
+                movies = [search.get() for search in searches]
+    """
+    def __init__(self, provider=None, workers=8):
+        if provider is None:
+            provider = LegendasTV(net.ConnectionPool(workers))
+        self.provider = provider
+        self._workers = ThreadPool(workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """ Wait for pending calls and release the workers """
+        self._workers.close()
+        self._workers.join()
+
+    def __getattr__(self, name):
+        method = getattr(self.provider, name)
+        if not callable(method):
+            return method
+        def async_method(*args, **kwargs):
+            callback = kwargs.pop('callback', None)
+            return self._workers.apply_async(method, args, kwargs, callback)
+        return async_method
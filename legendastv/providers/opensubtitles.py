@@ -22,14 +22,16 @@ from __future__ import unicode_literals
 
 import xmlrpclib
 import struct
+import socket
 import os
 import json
 import time
 import logging
+import threading
 
 log = logging.getLogger(__name__)
 
-from .. import g
+from .. import g, net
 from . import Provider
 
 
@@ -37,12 +39,64 @@ class OpenSubtitlesError(Exception):
     pass
 
 
+class TimeoutTransport(xmlrpclib.Transport):
+    """ XML-RPC transport with a socket timeout, capped by current
+        net.deadline(). xmlrpclib.Transport has none, waiting forever
+        for an unresponsive server.
+        Also accepts deflate besides gzip encoded responses, and decodes
+        them while they are parsed, instead of buffering the whole body
+    """
+    def __init__(self, timeout, use_datetime=0):
+        xmlrpclib.Transport.__init__(self, use_datetime)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        conn = xmlrpclib.Transport.make_connection(self, host)
+        conn.timeout = net.timeout(self.timeout)
+        if conn.sock:
+            conn.sock.settimeout(conn.timeout)
+        return conn
+
+    def send_request(self, connection, handler, request_body):
+        connection.putrequest("POST", handler, skip_accept_encoding=True)
+        connection.putheader("Accept-Encoding", net.ACCEPT_ENCODING)
+
+    def parse_response(self, response):
+        encoding = response.getheader("Content-Encoding", "").strip().lower()
+        decompressor = None
+        if encoding in net.ENCODINGS:
+            decompressor = net.Decompressor(encoding)
+
+        p, u = self.getparser()
+        while True:
+            chunk = data = response.read(16*1024)
+            if decompressor is not None:
+                data = (decompressor.decompress(chunk) if chunk else
+                        decompressor.flush())
+            if data:
+                p.feed(data)
+            if not chunk:
+                break
+        p.close()
+        return u.close()
+
+
 class Osdb(object):
+    url = 'http://api.opensubtitles.org/xml-rpc'
+
+    # Server expires login tokens after 15 minutes of inactivity
+    token_ttl = 14 * 60
+
     def __init__(self, username="", password="", language=""):
-        self.osdb = xmlrpclib.ServerProxy('http://api.opensubtitles.org/xml-rpc')
+        self.token = None
+        self.stamp = 0
+        self.breaker = net.get_breaker('api.opensubtitles.org')
+        self.osdb = xmlrpclib.ServerProxy(
+            self.url, TimeoutTransport(g.options['timeout']))
         try:
             self.LogIn(username, password, language)
-        except xmlrpclib.ProtocolError as e:
+        except (xmlrpclib.ProtocolError, socket.error,
+                net.CircuitOpenError) as e:
             log.warn("Could not login to OSDB, some services may not work: %s", e)
 
 
@@ -53,6 +107,10 @@ class Osdb(object):
                                      "Legendas.TV v%s" % g.globals['version'])
 
 
+    def expired(self):
+        """ Whether login token is missing or may have expired """
+        return not self.token or time.time() - self.stamp > self.token_ttl
+
     def LogOut(self):
         if self.token:
             self._osdb_call("LogOut")
@@ -77,8 +135,27 @@ class Osdb(object):
         if name not in ['ServerInfo', 'LogIn', 'GetSubLanguages']:
             args = (self.token,) + args
 
-        # Do the XML-RPC call
-        res = getattr(self.osdb, name)(*args)
+        # Do the XML-RPC call, failing fast if the server is down
+        trial = self.breaker.before()
+        try:
+            res = getattr(self.osdb, name)(*args)
+        except (xmlrpclib.ProtocolError, socket.error) as e:
+            if getattr(e, 'errcode', 500) >= 500:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+        except xmlrpclib.Fault:
+            # The server is up, it just rejected the call
+            self.breaker.success()
+            raise
+        else:
+            self.breaker.success()
+        finally:
+            # A trial with no answer must not keep the circuit half open
+            if trial:
+                self.breaker.release()
+        self.stamp = time.time()
         log.debug("OSDB.%s%r -> %r",
                   name, args[:1] + ('***',) + args[2:] if name == "LogIn" else args, res)
 
@@ -178,11 +255,25 @@ def videohash(filename):
     return b"%016x" % vhash
 
 
+_sessions = threading.local()
+
+
+def session():
+    """ Anonymous Osdb instance shared by calls from the same thread, as
+        xmlrpclib is not thread-safe. Logs in again once the previous token
+        may have expired
+    """
+    osdb = getattr(_sessions, 'osdb', None)
+    if osdb is None or osdb.expired():
+        osdb = _sessions.osdb = Osdb()
+    return osdb
+
+
 def videoinfo(filename, osdb=None):
     result = []
-    if osdb is None:
-        osdb = Osdb()
     try:
+        if osdb is None:
+            osdb = session()
         vhash = videohash(filename)
         result = osdb.CheckMovieHash2([vhash])
         if result:
@@ -192,7 +283,8 @@ def videoinfo(filename, osdb=None):
                 # OSDB returned a list instead of a dictionary, Lord knows why
                 log.warn("OSDB returned a list for hash '%s'", hash)
                 result = result[0]
-    except (xmlrpclib.ProtocolError, OpenSubtitlesError) as e:
+    except (xmlrpclib.ProtocolError, socket.error, OpenSubtitlesError,
+            net.CircuitOpenError) as e:
         log.error(e)
 
     return result
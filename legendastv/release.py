@@ -0,0 +1,319 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2012 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#    This file is part of Legendas.TV Subtitle Downloader
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+#
+# Release name tokenizer. Splits scene-like release names such as
+# 'Show.Name.S01E02.720p.HDTV.x264-GROUP' or 'Movie (2010) [1080p] BluRay'
+# into structured fields, in a single pass of dict lookups over its tokens
+
+from __future__ import unicode_literals, absolute_import, division
+
+import re
+
+from .entities import Release
+from .normalize import memoize
+
+# Known tokens, lowercase, by field, mapped to their canonical value.
+# Tokens split by separators are joined back by _PAIRS
+_FIELDS = dict(
+    resolution = {'480p': '480p', '576p': '576p', '720p': '720p',
+                  '1080p': '1080p', '1080i': '1080i', '2160p': '2160p',
+                  '4k': '2160p'},
+    source     = {'hdtv': 'hdtv', 'pdtv': 'pdtv', 'sdtv': 'sdtv', 'dsr': 'dsr',
+                  'webdl': 'web-dl', 'webrip': 'webrip', 'web': 'web',
+                  'bluray': 'bluray', 'bdrip': 'bdrip', 'brrip': 'brrip',
+                  'dvdrip': 'dvdrip', 'dvd': 'dvd', 'dvdscr': 'dvdscr',
+                  'hdrip': 'hdrip', 'hdcam': 'hdcam', 'cam': 'cam', 'r5': 'r5'},
+    codec      = {'x264': 'x264', 'h264': 'h264', 'avc': 'h264',
+                  'x265': 'x265', 'h265': 'h265', 'hevc': 'h265',
+                  'xvid': 'xvid', 'divx': 'divx'},
+    audio      = {'aac': 'aac', 'ac3': 'ac3', 'dts': 'dts', 'mp3': 'mp3',
+                  'flac': 'flac', 'truehd': 'truehd', 'atmos': 'atmos'},
+)
+
+# Flags, unlike the fields above, may also be part of titles
+_FLAGS = set(['proper', 'repack', 'real', 'internal', 'limited', 'extended',
+              'unrated', 'uncut', 'remastered', 'remux', 'hdr', '10bit', '3d',
+              'dubbed', 'subbed', 'multi', 'dual', 'itunes', 'amzn', 'nf',
+              'hulu', 'mp4', 'complete'])
+
+_PAIRS = {
+    ('web', 'dl')  : ('source', 'web-dl'),
+    ('web', 'rip') : ('source', 'webrip'),
+    ('blu', 'ray') : ('source', 'bluray'),
+    ('h', '264')   : ('codec', 'h264'),
+    ('h', '265')   : ('codec', 'h265'),
+    ('aac2', '0')  : ('audio', 'aac2.0'),
+    ('aac5', '1')  : ('audio', 'aac5.1'),
+    ('dd2', '0')   : ('audio', 'dd2.0'),
+    ('dd5', '1')   : ('audio', 'dd5.1'),
+    ('ddp5', '1')  : ('audio', 'ddp5.1'),
+    ('dts', 'hd')  : ('audio', 'dts-hd'),
+}
+
+_PAIR_FIRSTS = set(first for first, _ in _PAIRS)
+
+# Field tokens that are also common title words, as in "Charlotte's Web" or
+# 'Cam', only taken as fields after a year, season/episode or another field
+_AMBIGUOUS = set(['web', 'cam', 'r5', 'dsr', 'dvd', 'avc', 'dts', 'atmos',
+                  'flac'])
+
+_TOKENS = dict((token, (field, value))
+               for field, tokens in _FIELDS.iteritems()
+               for token, value in tokens.iteritems())
+
+# Leading or trailing [tags], like [rarbg], and separators
+_re_affixes = re.compile(r"^\s*\[[^]]*]|\[[^]]*]\s*$")
+_re_separators = re.compile(r"[][}{)(.,:_ -]+")
+
+# '-GROUP' at the end
+_re_group = re.compile(r"-\s*([^][}{)(.,:_ -]+)\s*$")
+
+# S01, S01E02, S01E02E03, S01E02-E03, 1x02
+_re_episode = re.compile(r"^s(\d{1,2})((?:e\d{1,3})*)$|^(\d{1,2})x(\d{2,3})$")
+_re_more_episodes = re.compile(r"^e(\d{1,3})$")
+_EPISODE_FIRSTS = set("s0123456789t")  # 't' for 'temporada'
+
+_SEASON_WORDS = set(['season', 'temporada'])
+
+
+def _episodes(numbers):
+    """ Tuple of episode numbers, the whole range if 2 or more """
+    if len(numbers) > 1:
+        return tuple(xrange(numbers[0], numbers[-1] + 1))
+    return tuple(numbers)
+
+
+def _is_year(token):
+    return len(token) == 4 and token[:2] in ('19', '20') and token.isdigit()
+
+
+@memoize()
+def parse_release(text):
+    """ Parse a release name into a Release of its fields. Unknown fields
+        are empty. Memoized, so the returned Release is shared and must not
+        be modified. Copy it first with Release.copy()
+    """
+    text = text.strip()
+    if '[' in text:
+        text = _re_affixes.sub("", text)
+    match = _re_group.search(text) if '-' in text else None
+    dashed = match.group(1) if match else None
+
+    words = [word for word in _re_separators.split(text) if word]
+    tokens = [word.lower() for word in words]
+
+    found = {}          # fields found, first value wins
+    season = None       # (season, episodes) of first season/episode found
+    title = []          # words before the first field
+    years = []          # positions of years in title
+    year = ""           # first year after title
+    tags = []
+    episode_title = []  # positions of words right after season/episode
+    unknown = None      # position of last other unknown word
+    count = len(tokens)
+    lookup = _TOKENS.get
+    i = 0
+    while i < count:
+        token = tokens[i]
+        hit = None
+
+        if token in _PAIR_FIRSTS and i + 1 < count:
+            hit = _PAIRS.get((token, tokens[i+1]))
+            if hit:
+                i += 1
+        if not hit:
+            hit = lookup(token)
+            if (hit and token in _AMBIGUOUS and not found and
+                    not (years and years[-1] > 0)):
+                hit = None
+        field, value = hit or (None, None)
+
+        if not field and token[0] in _EPISODE_FIRSTS:
+            match = _re_episode.match(token)
+            if match:
+                number, numbers, xseason, xepisode = match.groups()
+                if number:
+                    numbers = [int(n) for n in numbers.split('e') if n]
+                else:
+                    number, numbers = xseason, [int(xepisode)]
+                # S01E02-E03
+                while numbers and i + 1 < count:
+                    more = _re_more_episodes.match(tokens[i+1])
+                    if not more:
+                        break
+                    numbers.append(int(more.group(1)))
+                    i += 1
+                field, value = 'season', (int(number), _episodes(numbers))
+            elif (token in _SEASON_WORDS and i + 1 < count and
+                  tokens[i+1].isdigit() and len(tokens[i+1]) <= 2):
+                i += 1
+                field, value = 'season', (int(tokens[i]), ())
+
+        if field == 'season':
+            if season is None:
+                season = value
+            found[field] = True
+            episode_title = [i + 1]
+        elif field:
+            found.setdefault(field, value)
+        elif not found:
+            if _is_year(token):
+                years.append(len(title))
+            title.append(words[i])
+        elif not year and _is_year(token):
+            year = words[i]
+        elif token in _FLAGS:
+            tags.append(token)
+        elif episode_title and episode_title[-1] == i:
+            episode_title.append(i + 1)
+        else:
+            unknown = i
+        i += 1
+
+    # Year is the last one in title, so 'Blade Runner 2049 2017' is parsed
+    # as 'Blade Runner 2049', but a leading one is the title, as in '2012'
+    if years and years[-1] > 0:
+        year = title[years[-1]]
+        tags.extend(word.lower() for word in title[years[-1]+1:]
+                    if word.lower() in _FLAGS)
+        title = title[:years[-1]]
+
+    # Trailing flags, as in 'Movie.PROPER.720p'
+    while len(title) > 1 and title[-1].lower() in _FLAGS:
+        tags.append(title.pop().lower())
+
+    # Never an empty title, even for names starting with a field, as in
+    # 'S01E02.720p.HDTV'. The first word is still a better search than none
+    if not title and words:
+        title = words[:1]
+
+    # Group is the last word, if after fields and not a field itself, as
+    # in 'Movie.WEB-DL'. Either '-GROUP' or, if there is no dash, a word
+    # after fields but not right after season/episode, an episode title
+    episode_title = episode_title[:-1]
+    last = count - 1
+    group = ""
+    if dashed and dashed == words[last]:
+        if episode_title and episode_title[-1] == last:
+            unknown = episode_title.pop()
+        if unknown == last:
+            group = dashed
+    elif unknown == last:
+        group = words[last]
+
+    release = Release()
+    release.title = " ".join(title)
+    release.year = year
+    release.season, release.episodes = season or (None, ())
+    release.episode_title = " ".join(words[_] for _ in episode_title)
+    release.resolution = found.get('resolution', "")
+    release.source = found.get('source', "")
+    release.codec = found.get('codec', "")
+    release.audio = found.get('audio', "")
+    release.group = group
+    release.tags = tuple(tags)
+    return release
+
+
+# Spellings of known tokens that signature() makes canonical, as whole
+# words of a lowercase, space separated name
+_CANONICAL = dict((" ".join(pair), value) for pair, (_, value) in _PAIRS.items())
+_CANONICAL.update((token, value) for token, (_, value) in _TOKENS.items()
+                  if token != value)
+_re_canonical = re.compile(r"(?<![^ ])(?:%s|%s)(?![^ ])" % (
+    r"s\d{1,2}(?:e\d{1,3})*|\d{1,2}x\d{2,3}",
+    "|".join(re.escape(_) for _ in sorted(_CANONICAL, key=len, reverse=True))))
+
+
+def _canonical(match):
+    token = match.group()
+    if token in _CANONICAL:
+        return _CANONICAL[token]
+    if 'x' in token:
+        season, episode = token.split('x')
+        return "s%02de%02d" % (int(season), int(episode))
+    numbers = token[1:].split('e')
+    return "s%02d" % int(numbers[0]) + "".join("e%02d" % int(_)
+                                               for _ in numbers[1:])
+
+
+@memoize()
+def signature(text):
+    """ Canonical key of a release name, the same for names of the same
+        release that differ only in case, separators, [tags] and spelling
+        of known tokens, as 'Show.S01E02.WEB-DL.H.264-GRP' and
+        'show 1x02 webdl h264 grp'
+    """
+    text = text.strip()
+    if '[' in text:
+        text = _re_affixes.sub("", text)
+    key = " ".join(_re_separators.split(text.lower())).strip()
+    return _re_canonical.sub(_canonical, key)
+
+
+def signature_index(items, key=None):
+    """ Index of items by the signature() of their release names, given by
+        key(item), by default the items themselves. A dict of signature to
+        the list of items with that signature, in original order
+    """
+    index = {}
+    for item in items:
+        name = key(item) if key else item
+        sign = signature(name)
+        if sign:
+            index.setdefault(sign, []).append(item)
+    return index
+
+
+# Weights of fields when matching releases. The group, source and
+# resolution tell which encode the subtitle timings are synced to
+WEIGHTS = (
+    ('group'     , 4),
+    ('source'    , 2),
+    ('resolution', 2),
+    ('episodes'  , 2),
+    ('codec'     , 1),
+    ('audio'     , 1),
+)
+
+
+def comparable(release):
+    """ Whether Release has any field match_release() compares """
+    return any(release[field] for field, _ in WEIGHTS)
+
+
+def match_release(wanted, other):
+    """ Similarity of Release other to Release wanted in [0,1] range, by
+        their fields: for each field wanted has, its weight if other has the
+        same value, half if other has none, or nothing if different.
+        None if wanted has no fields to compare, only a title
+    """
+    total = score = 0
+    for field, weight in WEIGHTS:
+        value = wanted[field]
+        if not value:
+            continue
+        total += weight
+        theirs = other[field]
+        if not theirs:
+            score += weight / 2
+        elif theirs == value or (field == 'group' and
+                                 theirs.lower() == value.lower()):
+            score += weight
+    return score / total if total else None
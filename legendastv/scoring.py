@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2012 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#    This file is part of Legendas.TV Subtitle Downloader
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+#
+# Batch scoring of result sets. Each criteria is a column of features, one
+# per item, built once per result set, and scores are their weighted sum.
+# Columns are NumPy arrays if NumPy is installed and 'vectorize' option is
+# on, plain lists otherwise. Both give the very same scores, as operations
+# are done in the same order, and so the same ranking. Off by default, as
+# listings are too small to pay back the time to import NumPy
+
+from __future__ import division, absolute_import
+
+import logging
+
+from . import g, datatools as dt
+
+log = logging.getLogger(__name__)
+
+_numpy = None
+
+
+def numpy():
+    """ numpy module, or None if not installed or 'vectorize' option is off.
+        Imported on first use, as it is slow to import
+    """
+    global _numpy
+    if not g.options['vectorize']:
+        return None
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            log.debug("NumPy not installed, scoring with plain Python")
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+def distinct(func, items):
+    """ Column of func(item) for each of items, calling it once for each
+        distinct item, as results share titles and often releases
+    """
+    unique = dict((item, func(item)) for item in set(items))
+    return [unique[item] for item in items]
+
+
+def similarities(reference, texts, normalize=None):
+    """ Column of similarities between reference and each of texts, as
+        normalized by normalize(), if any. See distinct()
+    """
+    similarity = dt.similarity_engine()
+    if normalize is None:
+        return distinct(lambda text: similarity(reference, text), texts)
+    return distinct(lambda text: similarity(reference, normalize(text)), texts)
+
+
+def ages(dates, today):
+    """ Column of whole days elapsed from each of dates to today """
+    # Not in NumPy, its conversion from datetime objects is much slower
+    return [(today - date).days for date in dates]
+
+
+def recency(days, oldest, newest):
+    """ Column of recency in [0, 1] range of each of days old, 1 for the
+        newest and 0 for the oldest
+    """
+    np = numpy()
+    if oldest == newest:
+        return [1] * len(days)
+    if np is not None:
+        return 1 - (np.asarray(days) - newest) / (oldest - newest)
+    return [1 - (d - newest) / (oldest - newest) for d in days]
+
+
+def weighted_sum(columns):
+    """ Column of the weighted sum of columns, a list of (weight, column) """
+    np = numpy()
+    if np is not None:
+        total = 0
+        for weight, column in columns:
+            total = total + weight * np.asarray(column, dtype=float)
+        return total
+
+    total = [0] * len(columns[0][1])
+    for weight, column in columns:
+        total = [t + weight * c for t, c in zip(total, column)]
+    return total
+
+
+def rescale(column, low, high, top=10):
+    """ Column rescaled from [low, high] to [0, top] range """
+    if numpy() is not None:
+        return top * (column - low) / (high - low)
+    return [top * (c - low) / (high - low) for c in column]
+
+
+def ranking(scores):
+    """ Indexes of scores from greatest to lowest, ties in original order """
+    np = numpy()
+    if np is not None:
+        return np.argsort(-np.asarray(scores), kind='mergesort').tolist()
+    return sorted(xrange(len(scores)), key=scores.__getitem__, reverse=True)
+
+
+def tolist(column):
+    """ Column as a list of plain Python numbers """
+    return column.tolist() if hasattr(column, 'tolist') else list(column)
@@ -24,12 +24,8 @@ import shutil
 
 #import chardet  # Ubuntu: python-chardet, required by pysrt
 
-# There's 3 different `magic` modules, all wrappers to libmagic, with different API:
-# - Debian/Ubuntu: python-magic (from `file` source package, https://github.com/file/file)
-# - Pypi: python-magic (weird API, https://github.com/ahupp/python-magic)
-# - Pypi: filemagic (modern API, well-documented. https://github.com/aliles/filemagic)
-import magic
-import pysrt  # pypi: pysrt / Ubuntu (14.04 onwards): python-pysrt
+# magic and pysrt are imported on first use, in detect_encoding() and
+# open_subtitle(), so importing this module is cheap
 
 from . import g
 
@@ -115,6 +111,12 @@ def find_subtitles(paths, recursive=False):
 
 
 def detect_encoding(filename, fallback=None):
+    # There's 3 different `magic` modules, all wrappers to libmagic, with different API:
+    # - Debian/Ubuntu: python-magic (from `file` source package, https://github.com/file/file)
+    # - Pypi: python-magic (weird API, https://github.com/ahupp/python-magic)
+    # - Pypi: filemagic (modern API, well-documented. https://github.com/aliles/filemagic)
+    import magic
+
     encoding = ""
 
     # Debian's python-magic, from `file` upstream
@@ -156,6 +158,8 @@ def open_subtitle(filename, encoding=None, fallback=None):
     else:
         log.debug("Encoding: '%s'", encoding)
 
+    import pysrt  # pypi: pysrt / Ubuntu (14.04 onwards): python-pysrt
+
     try:
         return pysrt.open(filename, encoding=encoding)
     except UnicodeDecodeError as e:
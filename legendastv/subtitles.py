@@ -22,44 +22,30 @@
 from __future__ import unicode_literals, absolute_import, division
 
 import os
-import re
 import shutil
+import operator
 import logging
+import threading
 
-from . import g, datatools as dt, filetools as ft, srtclean
-from .providers import opensubtitles, legendastv as ltv
+from . import g, datatools as dt, filetools as ft, release as rl, srtclean, net
+from . import batch, normalize as nz
 from .utils import notify, print_debug
 
+# Provider modules are slow to import, so they are imported where used
+
 log = logging.getLogger(__name__)
 
 _provider = None
-_re_season_episode = re.compile(r"[S]?(?P<season>\d\d?)[Ex](?P<episode>\d\d?)",
-                                re.IGNORECASE)
-
+_provider_lock = threading.Lock()
 def guess_movie_info(text):
 
     text = text.strip()
 
-    # If 2+ years found, pick the last one and pray for a sane naming scheme
-    year = re.findall(r"(?<!\d)(?:19|20)\d{2}(?!\d)", text)
-    year = year[-1] if year else ""
-
+    # Title and year by release fields, dropping tags like '720p' and 'x264'
+    info = rl.parse_release(text)
     release = dt.clean_string(text)
 
-    if year:
-        title = release.split(year,1)[1 if release.startswith(year) else 0]
-    else:
-        title = release
-
-    # Remove some common "tags"
-    tags = ['1080p','720p','480p','hdtv','h264','x264','h65','dts','aac','ac3',
-            'bluray','bdrip','brrip','dvd','dvdrip','xvid','mp4','itunes',
-            'web dl','blu ray']
-    for s in tags:
-        title = re.sub(s, "", title, 0, re.IGNORECASE)
-    title = re.sub(" +", " ", title).strip()
-
-    result = dict(year=year, title=title, release=release)
+    result = dict(year=info.year, title=info.title, release=release)
     print_debug("Guessed title info: '%s' -> %s" % (text, result))
     return result
 
@@ -70,24 +56,45 @@ def get_provider():
     """
     global _provider
 
-    if _provider is not None:
-        return _provider
+    from .providers import legendastv as ltv
+
+    with _provider_lock:
+        if _provider is not None:
+            return _provider
 
-    notify("Logging in Legendas.TV", icon=g.globals['appicon'])
-    _provider = ltv.LegendasTV()
-    _provider.login(g.options['login'],
-                    g.options['password'])
+        notify("Logging in Legendas.TV", icon=g.globals['appicon'])
+        provider = ltv.LegendasTV()
+        provider.login(g.options['login'],
+                       g.options['password'])
 
-    if not _provider.auth:
-        raise g.LegendasError("Login failed, check your config file!")
+        if not provider.auth:
+            raise g.LegendasError("Login failed, check your config file!")
 
-    return _provider
+        _provider = provider
+        return _provider
 
 
 def retrieve_subtitle_for_movie(usermovie, login=None, password=None,
-                                remote=False):
+                                remote=False, deadline=None):
     """ Main function to find, download, extract and match a subtitle for a
-        selected file
+        selected file.
+        All steps must be done within deadline seconds, default from options,
+        or net.DeadlineExceeded is raised
+    """
+    if deadline is None:
+        deadline = g.options['deadline']
+
+    with net.deadline(deadline):
+        movie = movie_info(usermovie, remote)
+        result = retrieve_subtitles([movie], deadline)[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def movie_info(usermovie, remote=False):
+    """ Guess title, release and episode info of a video file, as a movie
+        dict suitable for retrieve_subtitles()
     """
     usermovie = os.path.abspath(usermovie)
     print_debug("Target: %s" % usermovie)
@@ -107,24 +114,190 @@ def retrieve_subtitle_for_movie(usermovie, login=None, password=None,
     movie.update({'episode': '',
                   'season': '',
                   'type': '',
+                  'savedir': savedir,
                   'dirname': dirname,
                   'filename': filename})
 
     # Try to tell movie from episode
-    data_obj = re.search(_re_season_episode, filename) # always use filename
-    if data_obj:
-        data = data_obj.groupdict()
+    info = rl.parse_release(filename) # always use filename
+    if info.episodes:
         movie['type']    = 'episode'
-        movie['season']  = data['season']
-        movie['episode'] = data['episode']
-        movie['title']   = movie['title'][:data_obj.start()].strip()
+        movie['season']  = "%d" % info.season
+        movie['episode'] = "%d" % info.episodes[0]
 
     # Get more useful info from OpenSubtitles.org
     # Only for local files, as the hashing used for video ID
     #  requires a full file copy over remote mounts (FTP/SSH)
     if not remote:
-        movie = update_movie_with_osdb(usermovie, movie)
+        with batch.network('opensubtitles'):
+            movie = update_movie_with_osdb(usermovie, movie)
+
+    if movie['type'] == 'episode':
+        movie['release'] = dt.clean_string(filename)
+
+    return movie
+
+
+def group_episodes(movies):
+    """ Group movies, as given by movie_info(), into lists of consecutive
+        episodes of the same series season. Other movies are groups of their
+        own. Each group is yielded as soon as the next movie shows it is
+        complete, so movies can be an iterable of videos still being
+        inspected, as listed in order by batch.find_videos()
+    """
+    group = []
+    season = None
+    for movie in movies:
+        key = None
+        if movie['type'] == 'episode' and movie['season']:
+            key = (nz.normalize(movie['title']), int(movie['season']))
+        if group and (key is None or key != season):
+            yield group
+            group = []
+        group.append(movie)
+        season = key
+    if group:
+        yield group
+
+
+def retrieve_subtitles(movies, deadline=None):
+    """ Find, download, extract and match subtitles for movies, as given by
+        movie_info(): a single movie, or episodes of the same season, as
+        grouped by group_episodes(). The title and its subtitles are searched
+        once for all, and each chosen archive, like a season pack, is
+        downloaded and extracted once.
+        Return a list of results, one for each movie, as returned by
+        retrieve_subtitle_for_movie(), or the exception that failed it, so
+        one episode can't fail the others. All steps, for all movies, must
+        be done within deadline seconds, default from options, or
+        net.DeadlineExceeded is raised or returned
+    """
+    if deadline is None:
+        deadline = g.options['deadline']
+
+    with net.deadline(deadline):
+        with batch.network('legendastv'):
+            title = find_title(movies[0])
+            if title is not None or len(movies) == 1:
+                for movie in movies:
+                    if title is not None:
+                        movie.update(title)
+                subs = list_subtitles(movies[0], title, good_subtitles(movies))
+
+        # Without a title, the release of each episode must be searched
+        if title is None and len(movies) > 1:
+            return [_retrieve_by_release(movie) for movie in movies]
+
+        return _retrieve_subtitles(movies, subs)
+
+
+def _retrieve_by_release(movie):
+    """ Result of retrieve_subtitles() for a single movie, searching
+        subtitles for its release
+    """
+    try:
+        with batch.network('legendastv'):
+            subs = list_subtitles(movie, None, good_subtitle(movie))
+    except Exception as e:
+        return _failure(movie, e)
+    return _retrieve_subtitles([movie], subs)[0]
+
+
+def _failure(movie, e):
+    """ Log an unexpected error retrieving a subtitle for movie, and return
+        it as its result. LegendasErrors are left to the caller to report
+    """
+    if not isinstance(e, g.LegendasError):
+        log.error("Error retrieving subtitle for %s: %s", movie['filename'],
+                  e, exc_info=1)
+    return e
+
+
+def _retrieve_subtitles(movies, subs):
+    """ Results of retrieve_subtitles() given the subtitles found for all
+        movies
+    """
+    results = [None] * len(movies)
+    if not subs:
+        # Are you *sure* this movie exists? Try our interactive mode
+        # and search for yourself. I swear I tried...
+        notify("No subtitles found")
+        return [False] * len(movies)
+
+    # Good! Lets choose and download the best subtitle...
+    notify("%s subtitles found", len(subs))
+
+    # Movies by chosen subtitle, a pack chosen for many episodes is
+    # downloaded only once
+    chosen = {}
+    with batch.cpu():
+        for i, movie in enumerate(movies):
+            try:
+                subtitle = choose_subtitle(movie, subs)
+            except g.LegendasError as e:
+                notify(e)
+                continue
+            except Exception as e:
+                results[i] = _failure(movie, e)
+                continue
+            chosen.setdefault(subtitle['hash'], (subtitle, []))[1].append(i)
+
+    for subtitle, indexes in sorted(chosen.values(),
+                                    key=lambda item: item[1][0]):
+        group = [movies[i] for i in indexes]
+        try:
+            done = _fetch_subtitle(subtitle, group)
+        except Exception as e:
+            done = [_failure(group[0], e)] * len(group)
+        for i, result in zip(indexes, done):
+            results[i] = result
+
+    return results
+
+
+def _fetch_subtitle(subtitle, movies):
+    """ Download and extract a subtitle, and save an srt file for each of
+        movies. Return a list of results, one for each movie
+    """
+    notify("Downloading '%s' from '%s'",
+           subtitle['release'],
+           subtitle['user_name'])
 
+    with batch.network('legendastv'):
+        archive = get_provider().downloadSubtitle(
+            subtitle['hash'], os.path.join(g.globals['cache_dir'], 'archives'),
+            overwrite=False)
+    if not archive:
+        notify("ERROR downloading archive!")
+        return [None] * len(movies)
+
+    net.check_deadline()
+    with batch.cpu():
+        try:
+            srtfiles = choose_srts(movies, archive)
+        except g.LegendasError as e:
+            notify(e)
+            return [None] * len(movies)
+
+        results = []
+        for movie, srtfile in zip(movies, srtfiles):
+            try:
+                net.check_deadline()
+                srtfile = clean_srt(srtfile)
+                shutil.copyfile(srtfile, os.path.join(
+                    movie['savedir'], "%s.srt" % movie['filename']))
+            except Exception as e:
+                results.append(_failure(movie, e))
+                continue
+            notify("DONE!")
+            results.append(True)
+    return results
+
+
+def find_title(movie):
+    """Search titles for a movie, as given by movie_info(), and return the
+        most similar one, or None if none is similar enough
+    """
     def season_to_ord(season):
         season = int(season)
         if   season == 1: tag = "st"
@@ -137,7 +310,6 @@ def retrieve_subtitle_for_movie(usermovie, login=None, password=None,
 
     # Let's begin with a movie search
     if movie['type'] == 'episode':
-        movie['release'] = dt.clean_string(filename)
         notify("Searching titles for '%s %s Season'",
                movie['title'],
                season_to_ord(movie['season']),
@@ -148,91 +320,79 @@ def retrieve_subtitle_for_movie(usermovie, login=None, password=None,
 
     movies = legendastv.getMovies(movie['title'])
 
-    if len(movies) > 0:
-        # Nice! Lets pick the best movie...
-        notify("%s titles found", len(movies))
+    if not movies:
+        # Ok, let's try by release...
+        notify("No titles found. Trying release...")
+        return
+
+    # Nice! Lets pick the best movie...
+    notify("%s titles found", len(movies))
 
-        # For Series, add Season to title and compare with native title
+    # For Series, add Season to title and compare with native title
+    if movie['type'] == 'episode':
+        season = " %d" % int(movie['season'])
+        search = 'title_br'
+    else:
+        season = ""
+        search = 'title'
+
+    for m in movies:
+        # Add a helper field: cleaned-up title
+        m['search'] = dt.clean_string(m[search])
+        # For episodes, clean further
         if movie['type'] == 'episode':
-            season = " %d" % int(movie['season'])
-            search = 'title_br'
-        else:
-            season = ""
-            search = 'title'
-
-        for m in movies:
-            # Add a helper field: cleaned-up title
-            m['search'] = dt.clean_string(m[search])
-            # For episodes, clean further
-            if movie['type'] == 'episode':
-                for tag in ['Temporada', 'temporada', 'Season', 'season', u'\xaa']:
-                    m['search'] = m['search'].replace(tag, "")
-                m['search'] = m['search'].strip()
-
-        # May the Force be with... the most similar!
-        title_to_search = dt.clean_string(g.mapping.get(movie['title'].lower(), movie['title']))
-        result = dt.choose_best_by_key(title_to_search + season, movies, 'search')
-
-        # But... Is it really similar?
-        if len(movies) == 1 or result['similarity'] > g.options['similarity']:
-            movie.update(result['best'])
-
-            if movie['type'] == 'episode':
-                notify("Searching subs for '%s' - Episode %d",
-                       result['best']['title_br'],
-                       int(movie['episode']),
-                       icon=os.path.join(g.globals['cache_dir'], 'thumbs',
-                                         os.path.basename(result['best']['thumb'] or "")))
-            else:
-                notify("Searching subs for '%s'", result['best']['title'],
-                       icon=os.path.join(g.globals['cache_dir'], 'thumbs',
-                                         os.path.basename(result['best']['thumb'] or "")))
-
-            subs = legendastv.getSubtitlesByMovie(movie)
+            for tag in ['Temporada', 'temporada', 'Season', 'season', u'\xaa']:
+                m['search'] = m['search'].replace(tag, "")
+            m['search'] = m['search'].strip()
 
-        else:
-            # Almost giving up... forget movie matching
-            notify("None was similar enough. Trying release...")
-            subs = legendastv.getSubtitlesByText(movie['release'])
+    # May the Force be with... the most similar!
+    title_to_search = dt.clean_string(g.mapping.get(movie['title'].lower(), movie['title']))
+    result = dt.choose_best_by_key(title_to_search + season, movies, 'search')
 
-    else:
-        # Ok, let's try by release...
-        notify("No titles found. Trying release...")
-        subs = legendastv.getSubtitlesByText(movie['release'])
+    # But... Is it really similar?
+    if len(movies) == 1 or result['similarity'] > g.options['similarity']:
+        return result['best']
 
-    if not subs:
-        # Are you *sure* this movie exists? Try our interactive mode
-        # and search for yourself. I swear I tried...
-        notify("No subtitles found")
-        return False
+    # Almost giving up... forget movie matching
+    notify("None was similar enough. Trying release...")
 
-    # Good! Lets choose and download the best subtitle...
-    notify("%s subtitles found", len(subs))
 
+def list_subtitles(movie, title=None, until=None):
+    """Return the subtitles of a title, as chosen by find_title() and already
+        merged into movie, or, without a title, for the release of movie.
+        until is passed along to getSubtitles(). A listing cut short by a
+        website failure is used as far as it goes
+    """
+    from .providers import legendastv as ltv
     try:
-        subtitle = choose_subtitle(movie, subs)
-    except g.LegendasError as e:
-        notify(e)
-        return
+        return _list_subtitles(movie, title, until)
+    except ltv.IncompleteListing as e:
+        log.warn("Choosing from %d subtitles only: %s", len(e.subtitles), e)
+        return e.subtitles
 
-    notify("Downloading '%s' from '%s'",
-           subtitle['release'],
-           subtitle['user_name'])
 
-    archive = legendastv.downloadSubtitle(subtitle['hash'],
-                                          os.path.join(g.globals['cache_dir'],
-                                                       'archives'),
-                                          overwrite=False)
-    if not archive:
-        notify("ERROR downloading archive!")
-        return
+def _list_subtitles(movie, title, until):
+    legendastv = get_provider()
 
-    try:
-        srtfile = choose_srt(movie, archive)
-    except g.LegendasError as e:
-        notify(e)
-        return
+    if title is None:
+        return legendastv.getSubtitlesByText(movie['release'], until=until)
+
+    if movie['type'] == 'episode':
+        notify("Searching subs for '%s' - Episode %d",
+               title['title_br'],
+               int(movie['episode']),
+               icon=legendastv.getThumbnail(title))
+    else:
+        notify("Searching subs for '%s'", title['title'],
+               icon=legendastv.getThumbnail(title))
+
+    return legendastv.getSubtitlesByMovie(movie, until=until)
 
+
+def clean_srt(srtfile):
+    """Clean up an srt file and convert it to UTF-8 with srtclean. Return the
+        cleaned file, srtfile itself if it needed no changes
+    """
     srtclean.main(['--in-place', '--convert', 'UTF-8', srtfile])
     srtbackup = "%s.srtclean.bak" % srtfile
     # If srtclean modified the subtitle,
@@ -242,9 +402,7 @@ def retrieve_subtitle_for_movie(usermovie, login=None, password=None,
         os.rename(srtfile, cleanfile)
         os.rename(srtbackup, srtfile)
         srtfile = cleanfile
-    shutil.copyfile(srtfile, os.path.join(savedir, "%s.srt" % filename))
-    notify("DONE!")
-    return True
+    return srtfile
 
 
 def update_movie_with_osdb(path, movie):
@@ -268,6 +426,8 @@ def update_movie_with_osdb(path, movie):
 
 
 def find_osdb_movie(path, movie):
+    from .providers import opensubtitles
+
     # Search OSDB by hash and get filtered list of results
     osdb_movies = [m for m in opensubtitles.videoinfo(path)
                    if m['MovieKind'] != 'tv series' and
@@ -297,27 +457,92 @@ def find_osdb_movie(path, movie):
     return dt.choose_best_by_key(search, osdb_movies, 'search')['best']
 
 
+def matches_episode(movie, sub):
+    """For TV Series, whether a subtitle is a pack or for the movie episode.
+        Always True for movies
+    """
+    if movie['type'] != 'episode':
+        return True
+
+    episodes = rl.parse_release(sub['release']).episodes
+    # Check whether the episode matches. The subtitle should never
+    # be selected if the episode doesn't match, even if it's a pack.
+    if episodes:
+        return int(movie['episode']) in episodes
+    return sub['pack']
+
+
+def release_signatures(movie):
+    """Signatures of the releases a movie may be named after, see
+        release.signature(): its filename and the release guessed from it
+        or its dir name. Empty if unknown
+    """
+    return [sign for sign in (rl.signature(movie.get('filename', "")),
+                              rl.signature(movie.get('release', "")))
+            if sign]
+
+
+def find_same_release(movie, index):
+    """Return the list of items in index, as built by release.signature_index(),
+        for the very same release of movie, differing only in punctuation,
+        or None if there is none. Exact, so no fuzzy matching needed
+    """
+    for sign in release_signatures(movie):
+        if sign in index:
+            print_debug("Same release as '%s': %d" % (sign, len(index[sign])))
+            return index[sign]
+
+
+def good_subtitle(movie):
+    """Return a predicate for a subtitle good enough for a movie to stop
+        searching for more, as set by 'stop_score' option, or None if disabled.
+        A subtitle for the very same release is always good enough
+    """
+    if not g.options['stop_score']:
+        return
+
+    score = get_provider().scoreAtLeast(movie, g.options['stop_score'])
+    signatures = set(release_signatures(movie))
+    return lambda sub: matches_episode(movie, sub) and (
+        rl.signature(sub['release']) in signatures or score(sub))
+
+
+def good_subtitles(movies):
+    """Return a predicate for a subtitle listing good enough for all movies,
+        once each has a good_subtitle(), or None if disabled
+    """
+    goods = [good_subtitle(movie) for movie in movies]
+    if None in goods:
+        return
+    return _until_all(goods, set(xrange(len(goods))))
+
+
+def _until_all(goods, pending):
+    """ Predicate true once each of goods predicates, by their indexes still
+        pending, was true for a subtitle. Its copy() has the same state,
+        and can be tested without changing it, see iterSubtitles()
+    """
+    def until(sub):
+        pending.difference_update([i for i in pending if goods[i](sub)])
+        return not pending
+    until.copy = lambda: _until_all(goods, set(pending))
+    return until
+
+
 def choose_subtitle(movie, subs):
     """Choose a subtitle from subs for a movie"""
 
     legendastv = get_provider()
 
     # For TV Series, consider only packs and matching episodes
-    if movie['type'] == 'episode':
-        episodes = []
-        for sub in subs:
-            data_obj = re.search(_re_season_episode, sub['release'])
-            # Check whether the episode matches. The subtitle should never
-            # be selected if the episode doesn't match, even if it's a pack.
-            if data_obj:
-                data = data_obj.groupdict()
-                if int(data['episode']) == int(movie['episode']):
-                    episodes.append(sub)
-            elif sub['pack']:
-                episodes.append(sub)
-        subs = episodes
-
-    subtitles = legendastv.rankSubtitles(movie, subs)
+    subs = [sub for sub in subs if matches_episode(movie, sub)]
+
+    # Subtitles for the very same release beat all others, so only those
+    # need ranking, if any
+    same = find_same_release(
+        movie, rl.signature_index(subs, operator.itemgetter('release')))
+
+    subtitles = legendastv.rankSubtitles(movie, same or subs)
     if not subtitles:
         raise g.LegendasError("No subtitles found for episode %d" %
                               int(movie['episode']))
@@ -327,13 +552,20 @@ def choose_subtitle(movie, subs):
 
 def choose_srt(movie, archive):
     """Extract an archive and choose an srt file for a movie"""
+    return choose_srts([movie], archive)[0]
+
+
+def choose_srts(movies, archive):
+    """Extract an archive and choose an srt file for each of movies, such
+        as the episodes of a season pack, in a single pass over its files
+    """
 
     files = ft.extract_archive(archive, extlist=["srt"])
     if not files:
         raise g.LegendasError("ERROR! Archive is corrupt or has no subtitles")
 
     if len(files) == 1:
-        return files[0]  # so much easier...
+        return files * len(movies)  # so much easier...
 
     # Damn those multi-file archives!
     notify("%s subtitles in archive", len(files))
@@ -344,18 +576,36 @@ def choose_srt(movie, archive):
                   full=f)
              for f in files]
 
+    index = rl.signature_index(files, operator.itemgetter('compare'))
+
+    # Files by episode, for series
+    episodes = {}
+    if any(movie['type'] == 'episode' for movie in movies):
+        for item in files:
+            for episode in rl.parse_release(item['original']).episodes:
+                episodes.setdefault(episode, []).append(item)
+
+    return [_choose_srt(movie, files, index, episodes)['full']  # back to string
+            for movie in movies]
+
+
+def _choose_srt(movie, files, index, episodes):
+    """Choose from files of an archive the one for a movie, see choose_srts()"""
+
+    # The one for the very same release, if any
+    same = find_same_release(movie, index)
+    if same:
+        print_debug("Chosen for same release: %s" % same[0]['original'])
+        return same[0]
+
     # If Series, match by Episode
     srt = None
     if movie['type'] == 'episode':
-        for item in files:
-            data_obj = re.search(_re_season_episode, item['original'])
-            if data_obj:
-                data = data_obj.groupdict()
-                if int(data['episode']) == int(movie['episode']):
-                    item['similarity'] = dt.get_similarity(movie['release'],
-                                                           item['compare'])
-                    if not srt or item['similarity'] > srt['similarity']:
-                        srt = item
+        best = None
+        for item in episodes.get(int(movie['episode']), []):
+            similarity = dt.get_similarity(movie['release'], item['compare'])
+            if not srt or similarity > best:
+                srt, best = item, similarity
         if srt:
             print_debug("Chosen for episode %s: %s" % (movie['episode'],
                                                        srt['original']))
@@ -374,4 +624,4 @@ def choose_srt(movie, archive):
                                            files, 'compare')
         srt = result['best']
 
-    return srt['full'] # convert back to string
+    return srt
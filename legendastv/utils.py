@@ -20,7 +20,6 @@
 # Miscellaneous utilities
 
 import os
-import dbus
 import logging
 
 from . import g
@@ -43,6 +42,7 @@ def notify(body, *args, **kwargs):
 
     # Use the same interface object in all calls
     if not g.globals['notifier']:
+        import dbus  # slow to import, and only needed here
         _bus_name = 'org.freedesktop.Notifications'
         _bus_path = '/org/freedesktop/Notifications'
         _bus_obj  = dbus.SessionBus().get_object(_bus_name, _bus_path)